@@ -14,18 +14,32 @@ from boto.dynamodb2.items import Item
 from boto.dynamodb2.table import Table
 from boto.dynamodb2.fields import HashKey, RangeKey
 from boto.dynamodb2.types import NUMBER, STRING
-from boto.dynamodb2.exceptions import ItemNotFound
+from boto.dynamodb2.exceptions import ItemNotFound, ConditionalCheckFailedException
 from boto.exception import JSONResponseError
 
-from copy import deepcopy
+from copy import copy, deepcopy
+from functools import partial
 
 import time
+import threading
+import Queue
 import datastore.core
 import json
+import math
 from datastore.core import Key, Namespace
+from datastore.core.query import Filter, Query
 from bson import json_util
 from decimal import *
+from collections import defaultdict, Counter
 from itertools import chain, groupby
+from .hedge import HedgedReads
+from .paging import PageToken
+from .shard import HashRing
+from .expression import FilterExpression, ExpressionConnection
+from .cache import SharedItemCache
+from .bulk import RateLimiter
+from .codec import KeyCodec
+from .size import ItemTooLarge, SizeSampler, MAX_ITEM_SIZE, item_size, read_units, write_units
 
 class Doc(object):
     '''Document key constants for datastore documents.'''
@@ -35,6 +49,14 @@ class Doc(object):
     value = 'val'
     wrapped = '_wrapped'
 
+    # Attributes stored as is, rather than wrapped
+    reserved = frozenset([key, hashkey, wrapped, _id])
+
+class Encoding(object):
+    '''Encodings for values other than strings and numbers.'''
+    json = 'json'       # JSON strings, opaque to DynamoDB
+    native = 'native'   # DynamoDB map, list, boolean and set types
+
 class DynamoDatastore(datastore.Datastore):
     '''Represents a AWS DynamoDB database as a datastore.
 
@@ -57,6 +79,9 @@ class DynamoDatastore(datastore.Datastore):
       None
 
     '''
+    # Maximum number of requests in a BatchWriteItem call
+    BATCH_WRITE_SIZE = 25
+
     @staticmethod
     def _table_has_range_key(key):
         return '.' in key.name
@@ -78,33 +103,95 @@ class DynamoDatastore(datastore.Datastore):
 
     @staticmethod
     def _should_pickle(key, val):
-        return not key in [Doc.key, Doc.hashkey, Doc.wrapped, Doc._id]
+        return key not in Doc.reserved
 
     @staticmethod
-    def _wrap_value(value):
+    def _wrap_value(value, encoding=Encoding.json):
         # We want to preserve data types as much as possible, so that querying remains intuitive
         # i.e. 2 < 10 whereas '10' < '2'
         if isinstance(value, basestring):
             return value
         elif type(value) in [int, long, float]:
+            if encoding == Encoding.native and type(value) is float and DynamoDatastore._native_float(value):
+                return DynamoDatastore._native_number(value)
             return value
+        elif encoding == Encoding.native:
+            return DynamoDatastore._wrap_native(value)
         else:
             return '__json__=' + json.dumps(value, default=json_util.default)
 
+    @staticmethod
+    def _native_float(value):
+        '''Returns whether float `value` round-trips as a DynamoDB number: it is
+        finite, and does not read back as an int.
+        '''
+        return not (math.isinf(value) or math.isnan(value) or value.is_integer())
+
+    @staticmethod
+    def _native_number(value):
+        '''Returns float `value` as the Decimal boto stores exactly. Its repr is
+        the shortest string that reads back as the same float.
+        '''
+        return Decimal(repr(value))
+
+    @staticmethod
+    def _native_floats(value):
+        '''Returns whether all floats in `value` round-trip as DynamoDB numbers.'''
+        if type(value) is float:
+            return DynamoDatastore._native_float(value)
+        elif isinstance(value, dict):
+            return all(DynamoDatastore._native_floats(v) for v in value.itervalues())
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            return all(DynamoDatastore._native_floats(v) for v in value)
+        return True
+
+    @staticmethod
+    def _wrap_native(value, nested=False):
+        '''Maps `value` onto native DynamoDB types where they round-trip exactly,
+        falling back to JSON otherwise (e.g. for datetime or ObjectId values).
+        Top-level None and empty containers fall back too, as boto drops them,
+        and so do values holding floats that would read back as ints (1.0).
+        '''
+        if not nested and not DynamoDatastore._native_floats(value):
+            return DynamoDatastore._wrap_value(value)
+
+        wrap = lambda v: DynamoDatastore._wrap_native(v, nested=True)
+        numbers = [int, long, float, Decimal]
+
+        if type(value) is float:
+            return DynamoDatastore._native_number(value)
+        elif isinstance(value, basestring) or type(value) in numbers + [bool]:
+            return value
+        elif value is None and nested:
+            return value
+        elif isinstance(value, (list, tuple)) and (value or nested):
+            return [wrap(v) for v in value]
+        elif isinstance(value, dict) and (value or nested) and all(isinstance(k, basestring) for k in value):
+            return dict((k, wrap(v)) for (k,v) in value.iteritems())
+        elif isinstance(value, (set, frozenset)) and value:
+            if all(isinstance(v, basestring) for v in value):
+                return set(value)
+            elif all(type(v) in numbers for v in value):
+                return set(DynamoDatastore._native_number(v) if type(v) is float else v for v in value)
+        return DynamoDatastore._wrap_value(value)
+
     @staticmethod
     def _wrap(table, key, value):
         '''Returns a value to insert. Non-documents are wrapped in a document.'''
-        
+        encoding = table.encoding
+        wrap_value = DynamoDatastore._wrap_value
+        should_pickle = DynamoDatastore._should_pickle
+
         if not isinstance(value, dict):
-            wrapped = {Doc.value:DynamoDatastore._wrap_value(value), Doc.wrapped:True}
+            wrapped = {Doc.value:wrap_value(value, encoding), Doc.wrapped:True}
         else:
-            wrapped = dict( (k, DynamoDatastore._wrap_value(v)) for (k,v) in value.iteritems() if DynamoDatastore._should_pickle(k,v) )
-        
+            wrapped = dict( (k, wrap_value(v, encoding)) for (k,v) in value.iteritems() if should_pickle(k,v) )
+
         if table.hash_key == Doc.hashkey:
             pk = table.primary_key_from_key(key)
             wrapped[Doc.hashkey] = pk[table.hash_key]
         table.validate_key_for_value(key, wrapped)
-        
+
         wrapped[Doc.key] = str(key)
 
         return wrapped
@@ -123,6 +210,13 @@ class DynamoDatastore(datastore.Datastore):
                 return long(value)
             else:
                 return float(value)
+        # Native DynamoDB types
+        elif isinstance(value, list):
+            return [DynamoDatastore._unwrap_value(v) for v in value]
+        elif isinstance(value, dict):
+            return dict((k, DynamoDatastore._unwrap_value(v)) for (k,v) in value.iteritems())
+        elif isinstance(value, set):
+            return set(DynamoDatastore._unwrap_value(v) for v in value)
         return value
 
     @staticmethod
@@ -144,14 +238,35 @@ class DynamoDatastore(datastore.Datastore):
 
         return value
 
-    def __init__(self, conn, prefix=""):
+    def __init__(self, conn, prefix="", hedge=None, consistent=False, token_secret=None,
+                 encoding=Encoding.json, cache=None, size_sampling=None):
         self.conn = conn
         self.prefix = prefix
 
+        # Optional SharedItemCache, caching items for all processes on the host
+        self.cache = cache
+        self._dynamo_hits = 0
+        self._dynamo_misses = 0
+
+        # How to store values other than strings and numbers, see Encoding
+        self.encoding = encoding
+
+        # Secret to sign and verify page tokens with
+        self.token_secret = token_secret
+
+        # Default read consistency, when not specified per call
+        self.consistent = consistent
+
+        # Optional HedgedReads, duplicating slow reads onto alternate connections
+        self.hedge = hedge
+
+        # Fraction of items read and written whose size is recorded, see item_sizes
+        self.sizes = SizeSampler(size_sampling) if size_sampling else None
+
         # Tables
         self._tables = {}
 
-    def _create_table(self, name, range_key=False):
+    def _create_table(self, name, range_key=False, conn=None):
         if range_key:
             schema = [
                 HashKey(Doc.hashkey, data_type=STRING),
@@ -162,21 +277,27 @@ class DynamoDatastore(datastore.Datastore):
                 HashKey(Doc.key, data_type=STRING) # by default, use single index
             ]
 
-        Table.create(name, schema=schema, connection=self.conn)
+        Table.create(name, schema=schema, connection=conn or self.conn)
 
 
-    def _table(self, key):
+    def _table(self, key, create=True):
         '''Returns the `table` corresponding to `key`.'''
-        name = self.prefix + self._table_name_for_key(key)
+        return self._table_named(self.prefix + self._table_name_for_key(key), key, create=create)
 
+    def _table_named(self, name, key, conn=None, create=True):
+        '''Returns the table `name`, creating it as needed to house `key`.
+        Returns None for a table that does not exist, unless `create` is set.
+        '''
         if not self._tables.get(name, None):
             # Let boto figure out the schema, so we don't have to worry about it
             # This comes at the cost of an extra call
-            table = DynamoTable(name, connection=self.conn)
+            table = DynamoTable(name, connection=conn or self.conn, encoding=self.encoding)
 
             # If we don't know yet for sure this table exists, check
             if not table.exists():
-                self._create_table(name, range_key=DynamoDatastore._table_has_range_key(key))
+                if not create:
+                    return None
+                self._create_table(name, range_key=DynamoDatastore._table_has_range_key(key), conn=conn)
 
             while not table.ready:
                 time.sleep(1)
@@ -189,47 +310,722 @@ class DynamoDatastore(datastore.Datastore):
     def tables(self):
         names = self.conn.list_tables().get('TableNames', [])
         def table_with_name(name):
-            table = DynamoTable(name, connection=self.conn)
+            table = DynamoTable(name, connection=self.conn, encoding=self.encoding)
             table.prepare()
             return table
 
         return [table_with_name(n) for n in names if n.startswith(self.prefix)]
 
-    def get(self, key):
-        '''Return the object named by key.'''
-        table = self._table(key)
-        
-        try:
-            item = table.get_item(**table.primary_key_from_key(key))
-        except ItemNotFound:
+    def _read(self, table, read, cost=1):
+        '''Performs `read(table)` of `cost` items, hedged across alternate
+        connections if enabled.
+        '''
+        if not self.hedge:
+            return read(table)
+
+        tables = [table] + [table.with_connection(c) for c in self.hedge.conns]
+        return self.hedge.read([partial(read, t) for t in tables], cost=cost)
+
+    def _consistent(self, consistent):
+        return self.consistent if consistent is None else consistent
+
+    def session(self, window=10):
+        '''Returns a DynamoSession that reads its own writes for `window` seconds.'''
+        return DynamoSession(self, window=window)
+
+    def get(self, key, consistent=None):
+        '''Return the object named by key.
+        Pass `consistent` to override the datastore's default read consistency.
+        '''
+        return self._get(self._table(key), key, self._consistent(consistent))
+
+    def _get(self, table, key, consistent):
+        # Strongly consistent reads must not be served from the cache
+        use_cache = self.cache is not None and not consistent
+        if use_cache:
+            data = self._cache_get(table, key)
+            if data is not None:
+                return self._unwrap(data)
+            # Don't cache what we read if the item is written meanwhile
+            generation = self.cache.generation(self._cache_key(table, key))
+
+        def read(table):
+            try:
+                item = table.get_item(consistent=consistent, **table.primary_key_from_key(key))
+            except ItemNotFound:
+                return None
+            return item._data if item and item._data != {} else None
+
+        data = self._read(table, read)
+        if data is None:
+            self._dynamo_misses += 1
+            return None
+
+        self._dynamo_hits += 1
+        if self.sizes is not None:
+            self.sizes.record(table.table_name, item_size(data))
+        if use_cache:
+            self._cache_put(table, key, data, generation)
+        return self._unwrap(data)
+
+    @staticmethod
+    def _cache_key(table, key):
+        return '%s:%s' % (table.table_name, key)
+
+    def _cache_get(self, table, key):
+        raw = self.cache.get(self._cache_key(table, key))
+        if raw is None:
             return None
+        return dict((k, table._dynamizer.decode(v)) for (k, v) in json.loads(raw).iteritems())
 
-        return self._unwrap(item._data) if item and item._data != {} else None
+    def _cache_put(self, table, key, data, generation=None):
+        # Cache the item as DynamoDB returned it, in its wire format
+        raw = json.dumps(dict((k, table._dynamizer.encode(v)) for (k, v) in data.iteritems()))
+        self.cache.put(self._cache_key(table, key), raw, generation=generation)
+
+    def cache_stats(self):
+        '''Returns the hit rate of each tier `get` reads from: the shared cache
+        (if any) and DynamoDB itself, where a hit is an item that was found.
+        '''
+        lookups = self._dynamo_hits + self._dynamo_misses
+        stats = {'dynamo': {
+            'hits': self._dynamo_hits,
+            'misses': self._dynamo_misses,
+            'hit_rate': float(self._dynamo_hits) / lookups if lookups else 0.0,
+        }}
+        if self.cache is not None:
+            stats['shared'] = self.cache.stats
+        return stats
+
+    def get_many(self, keys, consistent=None):
+        '''Return the objects named by keys, in order. Missing objects are None.'''
+        keys = list(keys)
+        consistent = self._consistent(consistent)
+
+        # Group the (unique) keys per table, so that each table gets one batch
+        batches = {}
+        for key in keys:
+            table = self._table(key)
+            batch = batches.setdefault(table.table_name, (table, {}))
+            batch[1][str(key)] = key
+
+        found = {}
+        for table, batch_keys in batches.values():
+            def read(table, batch_keys=batch_keys):
+                pks = table.primary_keys_from_keys(batch_keys.values())
+                return [item._data for item in table.batch_get(keys=pks, consistent=consistent)]
+
+            for data in self._read(table, read, cost=len(batch_keys)):
+                found[data[Doc.key]] = self._unwrap(data)
+
+        return [found.get(str(key), None) for key in keys]
 
     def put(self, key, value):
         '''Stores the object.'''
-        table = self._table(key)
+        self._put(self._table(key), key, value)
 
+    def _put(self, table, key, value):
         value = self._wrap(table, key, value)
+
+        # Refuse oversized items before DynamoDB does, saving the request
+        size = item_size(value)
+        if size > MAX_ITEM_SIZE:
+            raise ItemTooLarge('Item %s is %d bytes, over the %d byte limit' % (key, size, MAX_ITEM_SIZE))
+        if self.sizes is not None:
+            self.sizes.record(table.table_name, size)
+
         item = Item(table, data=value)
         item.save(overwrite=True)
+        if self.cache is not None:
+            self.cache.invalidate(self._cache_key(table, key))
 
     def delete(self, key):
         '''Removes the object.'''
-        table = self._table(key)
+        self._delete(self._table(key), key)
+
+    def _delete(self, table, key):
         table.delete_item(**table.primary_key_from_key(key))
+        if self.cache is not None:
+            self.cache.invalidate(self._cache_key(table, key))
+
+    def item_sizes(self):
+        '''Returns the distribution of sampled item sizes per table, if
+        `size_sampling` is enabled.
+        '''
+        return self.sizes.stats() if self.sizes is not None else {}
+
+    def _mean_item_size(self, table):
+        '''Returns the expected size of an item in `table`: the sampled mean,
+        or else the (roughly six hourly updated) mean DynamoDB reports.
+        '''
+        mean = self.sizes.mean(table.table_name) if self.sizes is not None else None
+        if mean is None and table.item_count:
+            mean = float(table.size_bytes) / table.item_count
+        return mean or 0
+
+    def estimate_capacity(self, op, key=None, value=None, query=None, consistent=None, items=None):
+        '''Returns the capacity units DynamoDB is expected to consume for `op`:
+        read units for 'get' and 'query', write units for 'put' and 'delete'.
+
+        A 'put' is sized as `value` would be stored. 'get' and 'delete' size
+        `value` if given, and otherwise the table's mean item size. A 'query'
+        on an index reads its `items` (by default, query.limit) matching items;
+        a scan reads the whole table, or `limit` items, whatever its filters.
+        Queries on tables that do not exist yet are estimated at 0.
+        '''
+        consistent = self._consistent(consistent)
+        if op == 'query':
+            return sum(self._estimate_query(table, query, consistent, items)
+                       for table in self._query_tables(query, create=False))
+        if op not in ('get', 'put', 'delete'):
+            raise ValueError('Unknown operation %r, expected get, put, delete or query' % op)
+        if op == 'put' and value is None:
+            raise ValueError('Estimating a put requires the value to put')
+
+        table = self._table(key)
+        if value is not None:
+            size = item_size(self._wrap(table, key, value))
+        else:
+            size = self._mean_item_size(table)
+
+        if op == 'get':
+            return read_units(size, consistent)
+        return write_units(size)
+
+    def _estimate_query(self, table, query, consistent, items=None):
+        idx = DynamoQuery.index_for_query(table, query)
+        if idx:
+            # On a table without range key, the hash key matches one item at most
+            count = items or query.limit or (1 if idx.name is None and idx.range_key is None else None)
+            if count is None:
+                raise ValueError('Estimating an index query without a limit requires the number of items')
+            consistent = consistent and idx.index_type != 'global'
+        else:
+            count = query.limit or table.item_count
+            consistent = False
 
-    def contains(self, key):
+        # Reads are charged on the total size of the items read, not per item
+        return read_units(count * self._mean_item_size(table), consistent)
+
+    def contains(self, key, consistent=None):
         '''Returns whether the object is in this datastore.'''
         try:
-            return self.get(key) is not None
+            return self.get(key, consistent=consistent) is not None
         except ItemNotFound:
             return False
 
-    def query(self, query):
-        '''Returns a sequence of objects matching criteria expressed in `query`'''
+    def query(self, query, consistent=None, token=None):
+        '''Returns a sequence of objects matching criteria expressed in `query`.
+        Pass a `token` from page_token() to resume after an earlier cursor.
+        '''
+        if isinstance(token, basestring):
+            token = PageToken.decode(token, self.token_secret)
+
         table = self._table(query.key.child('_'))
-        return DynamoQuery.translate(table, query)
+        return DynamoQuery.translate(table, query, consistent=self._consistent(consistent), token=token)
+
+    def page_token(self, cursor):
+        '''Returns a (signed, if token_secret is set) token to resume after `cursor`.'''
+        return cursor.page_token(self.token_secret)
+
+    def _query_tables(self, query, create=True):
+        '''Returns the tables holding the objects `query` may match. Tables
+        that don't exist are left out, unless `create` is set.
+        '''
+        return [t for t in [self._table(query.key.child('_'), create=create)] if t]
+
+    def truncate(self, key_namespace, **kwargs):
+        '''Removes every object under `key_namespace`. See `delete_query`.'''
+        return self.delete_query(Query(key_namespace), **kwargs)
+
+    def delete_query(self, query, workers=4, rate=None, progress=None, resume=None):
+        '''Removes every object matching `query`.
+
+        Matching keys are found with a keys-only index query, or a parallel
+        scan over `workers` segments, and deleted with BatchWriteItem requests
+        of up to 25 keys, at most `rate` deletes per second across workers.
+
+        After every batch, `progress` is called with the state of the delete:
+        a JSON-serializable dict counting `deleted` objects, which can be
+        passed back as `resume` to continue an interrupted delete where it
+        stopped. Returns the final state.
+        '''
+        if query.limit:
+            raise ValueError('delete_query does not support query limits')
+
+        state = resume or {'workers': workers, 'deleted': 0, 'segments': {}}
+        limiter = RateLimiter(rate)
+        lock = threading.Lock()
+        errors = []
+
+        def delete_segment(table, idx, segment, segments):
+            name = '%s/%d' % (table.table_name, segment)
+            with lock:
+                done = state['segments'].setdefault(name, {'token': None, 'deleted': 0, 'done': False})
+            if done['done']:
+                return
+
+            # Fetch only what is needed to filter, delete, and resume
+            attributes = set(table.keys + [Doc.key] + [f.field.split('.')[0] for f in query.filters])
+            if idx:
+                attributes.update(k for k in [idx.hash_key, idx.range_key] if k)
+
+            token = PageToken.decode(done['token']) if done['token'] else None
+            cursor = DynamoQuery.translate(table, query, token=token, attributes=sorted(attributes),
+                segment=segment if segments > 1 else None, total_segments=segments if segments > 1 else None)
+
+            def flush(batch):
+                limiter.acquire(len(batch))
+                with table.batch_write() as writer:
+                    for pk in table.codec.project_many(resume_key for (resume_key, _) in batch):
+                        writer.delete_item(**pk)
+                if self.cache is not None:
+                    for (_, key) in batch:
+                        self.cache.invalidate(self._cache_key(table, key))
+
+                with lock:
+                    done['token'] = PageToken(batch[-1][0], index=cursor.index_name).encode()
+                    done['deleted'] += len(batch)
+                    state['deleted'] += len(batch)
+                    if progress:
+                        progress(state)
+
+            batch = []
+            for _ in cursor:
+                batch.append((cursor.resume_key, cursor.current_key))
+                if len(batch) == self.BATCH_WRITE_SIZE:
+                    flush(batch)
+                    batch = []
+            if batch:
+                flush(batch)
+
+            with lock:
+                done['done'] = True
+                if progress:
+                    progress(state)
+
+        def run(*args):
+            try:
+                delete_segment(*args)
+            except Exception, e:
+                errors.append(e)
+
+        # Nothing to delete from tables that don't exist, so don't create them
+        tables = self._query_tables(query, create=False)
+        if not tables:
+            return state
+
+        threads = []
+        for table in tables:
+            idx = DynamoQuery.index_for_query(table, query)
+            segments = 1 if idx else state['workers']
+            for segment in range(segments):
+                thread = threading.Thread(target=run, args=(table, idx, segment, segments))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return state
+
+class DynamoSession(datastore.ShimDatastore):
+    '''Wraps a DynamoDatastore to read its own writes.
+
+    Reads use strongly consistent reads only for keys (and queries only for
+    tables) this session wrote within the last `window` seconds, and cheaper
+    eventually consistent reads everywhere else. After a `delete_query` or
+    `truncate`, all reads of the collection are strongly consistent.
+
+      >>> session = ds.session(window=5)
+      >>> session.put(hello, 'world')
+      >>> session.get(hello)   # strongly consistent
+      'world'
+
+    '''
+    def __init__(self, datastore, window=10):
+        super(DynamoSession, self).__init__(datastore)
+        self.window = window
+
+        self._written_keys = {}
+        self._written_tables = {}
+        self._cleared = {}
+        self._pruned = time.time()
+
+    def _record_write(self, key):
+        now = time.time()
+        self._written_keys[str(key)] = now
+        # By collection, which a ShardedDynamoDatastore spreads over several tables
+        self._written_tables[self.child_datastore._table_name_for_key(key)] = now
+
+        # Drop writes that have fallen out of the window, at most once per window
+        if now - self._pruned > self.window:
+            for written in [self._written_keys, self._written_tables, self._cleared]:
+                for k, t in written.items():
+                    if now - t > self.window:
+                        del written[k]
+            self._pruned = now
+
+    def _recent(self, written, name):
+        return time.time() - written.get(name, 0) <= self.window
+
+    def wrote_key(self, key):
+        '''Returns whether this session wrote `key` within the window.'''
+        return self._recent(self._written_keys, str(key))
+
+    def wrote_table(self, key):
+        '''Returns whether this session wrote to the collection housing `key` within the window.'''
+        return (self._recent(self._written_tables, self.child_datastore._table_name_for_key(key))
+                or self.cleared(key))
+
+    def cleared(self, key):
+        '''Returns whether this session bulk deleted from the collection of
+        `key` (see `delete_query`) within the window.
+        '''
+        return bool(self._cleared) and self._recent(self._cleared, self.child_datastore._table_name_for_key(key))
+
+    def _wrote(self, key):
+        return self.wrote_key(key) or self.cleared(key)
+
+    def get(self, key, consistent=None):
+        if consistent is None:
+            consistent = self._wrote(key) or None
+        return self.child_datastore.get(key, consistent=consistent)
+
+    def get_many(self, keys, consistent=None):
+        keys = list(keys)
+        if consistent is not None:
+            return self.child_datastore.get_many(keys, consistent=consistent)
+
+        # Read only the keys written recently strongly, in a batch of their own
+        recent = [self._wrote(k) for k in keys]
+        if not any(recent):
+            return self.child_datastore.get_many(keys)
+        strong = [k for (k, r) in zip(keys, recent) if r]
+        eventual = [k for (k, r) in zip(keys, recent) if not r]
+
+        values = dict(zip(map(str, strong), self.child_datastore.get_many(strong, consistent=True)))
+        if eventual:
+            values.update(zip(map(str, eventual), self.child_datastore.get_many(eventual)))
+        return [values[str(k)] for k in keys]
+
+    def contains(self, key, consistent=None):
+        return self.get(key, consistent=consistent) is not None
+
+    def put(self, key, value):
+        self.child_datastore.put(key, value)
+        self._record_write(key)
+
+    def delete(self, key):
+        self.child_datastore.delete(key)
+        self._record_write(key)
+
+    def query(self, query, consistent=None, token=None):
+        if consistent is None:
+            consistent = self.wrote_table(query.key.child('_')) or None
+        return self.child_datastore.query(query, consistent=consistent, token=token)
+
+    def delete_query(self, query, **kwargs):
+        # The deleted keys are not known up front, so mark the whole collection
+        try:
+            return self.child_datastore.delete_query(query, **kwargs)
+        finally:
+            self._cleared[self.child_datastore._table_name_for_key(query.key.child('_'))] = time.time()
+
+    def truncate(self, key_namespace, **kwargs):
+        return self.delete_query(Query(key_namespace), **kwargs)
+
+class ShardedDynamoDatastore(DynamoDatastore):
+    '''Spreads collections over several DynamoDB tables, to scale past the
+    throughput and capacity of a single table.
+
+      >>> ds = datastore.dynamo.ShardedDynamoDatastore(conn, shards={'users': 8})
+
+    Keys are placed on shards by consistent hashing: `get`, `put` and `delete`
+    go to a single shard, while queries fan out to all shards in parallel and
+    merge their results.
+
+    `shards` is either the number of shards for every collection, or a dict
+    from table name (as returned by `_table_name_for_key`, without prefix) to
+    number of shards, for which other collections are not sharded. Shard 0 is
+    the collection's regular table, shard i the table `<name>-shard<i>`. When
+    `conns` are given, shard i talks to DynamoDB through `conns[i % len(conns)]`.
+
+    `migrating` maps table names to their number of shards before an ongoing
+    rebalance, for which reads fall back to the previous layout. To change
+    the number of shards of a collection, e.g. from 4 to 5:
+
+      1. Switch every process that writes to the collection over to
+         shards={'users': 5}, migrating={'users': 4}. Writers left on the old
+         layout write items onto shards the rebalance already moved away from.
+      2. Run `rebalance(Key('/users'))` in one process, with a `rate` that
+         leaves capacity for the live traffic. If it is interrupted, run it
+         again with the last state it reported as `resume`.
+      3. Drop `migrating` from the configuration.
+
+    '''
+    SHARD_SEPARATOR = '-shard'
+
+    # Results buffered per query, ahead of the consumer
+    MERGE_BUFFER = 100
+
+    def __init__(self, conn, shards=1, conns=None, migrating=None, **kwargs):
+        super(ShardedDynamoDatastore, self).__init__(conn, **kwargs)
+        self.shards = dict(shards) if isinstance(shards, dict) else {}
+        self.default_shards = 1 if isinstance(shards, dict) else shards
+        self.conns = conns or [conn]
+
+        self._rings = {}
+        self._migrating = dict(migrating or {})
+        self._stats = defaultdict(Counter)
+        self._stats_lock = threading.Lock()
+
+    def shard_count(self, name):
+        '''Returns the number of shards of the collection in table `name`.'''
+        return self.shards.get(name, self.default_shards)
+
+    def shard_stats(self):
+        '''Returns per shard table counters of gets, puts, deletes, queried and moved items.'''
+        with self._stats_lock:
+            return dict((name, dict(stats)) for (name, stats) in self._stats.iteritems())
+
+    def _count(self, table, stat, n=1):
+        with self._stats_lock:
+            self._stats[table.table_name][stat] += n
+
+    def _ring(self, shards):
+        if shards not in self._rings:
+            self._rings[shards] = HashRing(shards)
+        return self._rings[shards]
+
+    def _shard_table(self, name, shard, key, create=True):
+        shard_name = name if shard == 0 else '%s%s%d' % (name, self.SHARD_SEPARATOR, shard)
+        conn = self.conns[shard % len(self.conns)]
+        return self._table_named(self.prefix + shard_name, key, conn=conn, create=create)
+
+    def _table(self, key, shards=None, create=True):
+        '''Returns the shard `table` corresponding to `key`.'''
+        name = self._table_name_for_key(key)
+        shard = self._ring(shards or self.shard_count(name)).shard_for(str(key))
+        return self._shard_table(name, shard, key, create=create)
+
+    def _previous_table(self, key):
+        '''Returns the shard `key` lived on before an ongoing rebalance, if any.'''
+        shards = self._migrating.get(self._table_name_for_key(key), None)
+        return self._table(key, shards) if shards else None
+
+    def get(self, key, consistent=None):
+        '''Return the object named by key.'''
+        consistent = self._consistent(consistent)
+        table = self._table(key)
+        self._count(table, 'gets')
+        value = self._get(table, key, consistent)
+
+        previous = self._previous_table(key)
+        if value is None and previous not in [None, table]:
+            self._count(previous, 'gets')
+            value = self._get(previous, key, consistent)
+        return value
+
+    def get_many(self, keys, consistent=None):
+        '''Return the objects named by keys, in order. Missing objects are None.'''
+        keys = list(keys)
+        values = super(ShardedDynamoDatastore, self).get_many(keys, consistent=consistent)
+        for key in keys:
+            self._count(self._table(key), 'gets')
+
+        for (i, key) in enumerate(keys):
+            previous = self._previous_table(key)
+            if values[i] is None and previous not in [None, self._table(key)]:
+                self._count(previous, 'gets')
+                values[i] = self._get(previous, key, self._consistent(consistent))
+        return values
+
+    def put(self, key, value):
+        '''Stores the object.'''
+        table = self._table(key)
+        self._count(table, 'puts')
+        self._put(table, key, value)
+
+    def delete(self, key):
+        '''Removes the object, from its previous shard too during a rebalance.'''
+        table = self._table(key)
+        self._count(table, 'deletes')
+        self._delete(table, key)
+
+        previous = self._previous_table(key)
+        if previous not in [None, table]:
+            self._count(previous, 'deletes')
+            self._delete(previous, key)
+
+    def query(self, query, consistent=None, token=None):
+        '''Returns a sequence of objects matching criteria expressed in `query`,
+        merged from all shards.
+        '''
+        if token is not None:
+            raise ValueError('ShardedDynamoDatastore does not support page tokens')
+        if query.offset_key:
+            # Each shard would resume from a key of another shard's key space
+            raise ValueError('ShardedDynamoDatastore does not support query offset keys')
+
+        name = self._table_name_for_key(query.key.child('_'))
+        consistent = self._consistent(consistent)
+
+        tables = self._query_tables(query)
+        cursors = [DynamoQuery.translate(t, query, consistent=consistent) for t in tables]
+        iterable = self._merge(zip(tables, cursors), dedupe=name in self._migrating, limit=query.limit)
+        return datastore.Cursor(query, iterable)
+
+    def _query_tables(self, query, create=True):
+        '''Returns the shard tables of the collection `query` runs on, of both
+        layouts during a rebalance. Tables that don't exist are left out,
+        unless `create` is set.
+        '''
+        key = query.key.child('_')
+        name = self._table_name_for_key(key)
+        shards = max(self.shard_count(name), self._migrating.get(name, 0))
+        tables = [self._shard_table(name, i, key, create=create) for i in range(shards)]
+        return [t for t in tables if t]
+
+    def _merge(self, shard_cursors, dedupe=False, limit=None):
+        '''Iterates the shard cursors in parallel, yielding results as they arrive.
+        While rebalancing, an item can show up on two shards; `dedupe` skips repeats.
+        The shard cursors stop reading once `limit` results are yielded, or the
+        merged results are abandoned.
+        '''
+        results = Queue.Queue(self.MERGE_BUFFER)
+        stop = threading.Event()
+        done = object()
+
+        def put(result):
+            while not stop.is_set():
+                try:
+                    results.put(result, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def drain(table, cursor):
+            try:
+                for value in cursor:
+                    item_id = tuple(sorted((cursor.resume_key or {}).items()))
+                    if not put((table, item_id, value, None)):
+                        return
+            except Exception, e:
+                put((table, None, None, e))
+            put((table, None, done, None))
+
+        for (table, cursor) in shard_cursors:
+            thread = threading.Thread(target=drain, args=(table, cursor))
+            thread.daemon = True
+            thread.start()
+
+        seen = set()
+        running = len(shard_cursors)
+        yielded = 0
+        try:
+            while running and (limit is None or yielded < limit):
+                table, item_id, value, error = results.get()
+                if error:
+                    raise error
+                if value is done:
+                    running -= 1
+                    continue
+
+                self._count(table, 'queried')
+                if dedupe:
+                    if item_id in seen:
+                        continue
+                    seen.add(item_id)
+                yielded += 1
+                if yielded == limit:
+                    stop.set()
+                yield value
+        finally:
+            stop.set()
+
+    def rebalance(self, key_namespace, shards=None, rate=None, progress=None, resume=None):
+        '''Changes the number of shards of the collection at `key_namespace`
+        (e.g. Key('/users')) to `shards` (by default, the configured number),
+        and moves the items whose shard changed from the previous layout (by
+        default, as configured in `migrating`), at most `rate` items per second.
+
+        The collection stays online meanwhile: writes go to the new layout,
+        reads fall back to an item's previous shard, and queries span the
+        shards of both layouts. Items are copied only if the destination does
+        not have a newer write, but an item deleted while it is being moved
+        may come back. Other processes only do the same when configured with
+        `migrating`, see ShardedDynamoDatastore.
+
+        As in `delete_query`, `progress` is called every few items with the
+        state of the rebalance: a JSON-serializable dict counting `moved`
+        items, which can be passed back as `resume` to continue an interrupted
+        rebalance where it stopped. Returns the final state.
+        '''
+        key = key_namespace.child('_')
+        name = self._table_name_for_key(key)
+        if resume:
+            state = resume
+        else:
+            previous = self._migrating.get(name, self.shard_count(name))
+            state = {'from': previous, 'to': self.shard_count(name) if shards is None else shards,
+                     'moved': 0, 'shards': {}}
+        if state['to'] == state['from']:
+            return state
+
+        self._migrating[name] = state['from']
+        self.shards[name] = state['to']
+        limiter = RateLimiter(rate)
+
+        def report(done, last_key):
+            if last_key is not None:
+                done['token'] = PageToken(last_key).encode()
+            if progress:
+                progress(state)
+
+        for shard in range(state['from']):
+            # Nothing to move off shards that were never created
+            source = self._shard_table(name, shard, key, create=False)
+            if not source:
+                continue
+
+            done = state['shards'].setdefault(source.table_name, {'token': None, 'moved': 0, 'done': False})
+            if done['done']:
+                continue
+
+            scanned, last_key = 0, None
+            kwargs = {'exclusive_start_key': PageToken.decode(done['token']).last_key} if done['token'] else {}
+            for item in source.scan(**kwargs):
+                item_key = Key(item[Doc.key])
+                dest = self._table(item_key)
+                if dest is not source:
+                    limiter.acquire(1)
+                    try:
+                        dest._put_item(Item(dest, data=item._data).prepare_full(),
+                                       expects={Doc.key: {'Exists': False}})
+                    except ConditionalCheckFailedException:
+                        pass # written since the rebalance started, keep the newer value
+                    self._delete(source, item_key)
+
+                    self._count(dest, 'moved_in')
+                    self._count(source, 'moved_out')
+                    done['moved'] += 1
+                    state['moved'] += 1
+
+                last_key = dict((k, item._data.get(k)) for k in source.keys)
+                scanned += 1
+                if scanned % self.BATCH_WRITE_SIZE == 0:
+                    report(done, last_key)
+
+            done['done'] = True
+            report(done, last_key)
+
+        # Only stop falling back to the previous layout once everything moved
+        del self._migrating[name]
+        return state
 
 class DynamoTableIndex(object):
     name = None
@@ -260,6 +1056,24 @@ class DynamoTableIndex(object):
 class DynamoTable(Table):
     KEY_SEPARATOR = '.'
 
+    def __init__(self, table_name, encoding=Encoding.json, **kwargs):
+        super(DynamoTable, self).__init__(table_name, **kwargs)
+        self.encoding = encoding
+        if encoding == Encoding.native:
+            # Store booleans as BOOL rather than as numbers
+            self.use_boolean()
+
+    def _scan(self, filter_expression=None, attributes=None, **kwargs):
+        '''Performs a scan request, filtering with `filter_expression` when given.'''
+        if not filter_expression:
+            return super(DynamoTable, self)._scan(attributes=attributes, **kwargs)
+
+        # boto only knows legacy scan filters: add the expression on the way out
+        table = copy(self)
+        arguments = filter_expression.arguments(self._dynamizer, attributes=attributes)
+        table.connection = ExpressionConnection(self.connection, arguments)
+        return super(DynamoTable, table)._scan(**kwargs)
+
     def exists(self):
         try:
             self.prepare()
@@ -289,14 +1103,17 @@ class DynamoTable(Table):
 
             self._main_index = DynamoTableIndex.from_description(status['Table'])
 
-            sec_idx_desc = list(chain(*[status['Table'].get(name, []) for name in ['LocalSecondaryIndexes', 'GlobalSecondaryIndexes']]))
-            sec_indices = [DynamoTableIndex.from_description(desc) for desc in sec_idx_desc]
+            sec_idx_types = [('LocalSecondaryIndexes', 'local'), ('GlobalSecondaryIndexes', 'global')]
+            sec_indices = [DynamoTableIndex.from_description(desc, index_type) for (name, index_type) in sec_idx_types for desc in status['Table'].get(name, [])]
             
             hash_for_idx = lambda idx: idx.hash_key
             all_indices = sorted([self._main_index] + sec_indices, key=hash_for_idx)
             self._indices = {k: list(g) for (k,g) in groupby(all_indices, hash_for_idx)}
         
             self._datatypes = data_type_by_attribute(status['Table']['AttributeDefinitions'])
+            self._codec = self._compile_codec()
+            self._item_count = status['Table'].get('ItemCount', 0)
+            self._size_bytes = status['Table'].get('TableSizeBytes', 0)
             self._ready = True
 
     @property
@@ -307,6 +1124,16 @@ class DynamoTable(Table):
     def ready(self):
         return getattr(self, '_ready', False)
 
+    @property
+    def item_count(self):
+        '''Number of items in the table, as last described by DynamoDB.'''
+        return getattr(self, '_item_count', 0)
+
+    @property
+    def size_bytes(self):
+        '''Size of the table in bytes, as last described by DynamoDB.'''
+        return getattr(self, '_size_bytes', 0)
+
     @property
     def datatypes(self):
         return getattr(self, '_datatypes', None)
@@ -324,6 +1151,28 @@ class DynamoTable(Table):
     def keys(self):
         return [k for k in [self.hash_key, self.range_key] if k is not None]
 
+    @property
+    def codec(self):
+        '''The KeyCodec for this table's schema, compiled by prepare().'''
+        codec = getattr(self, '_codec', None)
+        if codec is None:
+            codec = self._codec = self._compile_codec()
+        return codec
+
+    def _compile_codec(self):
+        return KeyCodec(self.hash_key, self.range_key, self.datatypes,
+                        key_attribute=Doc.key, separator=self.KEY_SEPARATOR)
+
+    def with_connection(self, conn):
+        '''Returns a copy of this table that talks to DynamoDB through `conn`.'''
+        alternates = self.__dict__.setdefault('_alternates', {})
+        if id(conn) not in alternates:
+            table = copy(self)
+            table.connection = conn
+            table._alternates = {}
+            alternates[id(conn)] = table
+        return alternates[id(conn)]
+
     def indices_for_hash_key(self, hash_key):
         return self._indices.get(hash_key, [])
 
@@ -333,36 +1182,7 @@ class DynamoTable(Table):
         are certain limitations on the Key format so that we can always deduce the
         Dynamo primary key from the datastore Key
         '''
-        valid = True
-
-        if self.range_key:
-            if type(value) != dict:
-                raise ValueError('Underlying DynamoDB table requires values to be a dictionary')
-
-            hash_val = value.get(self.hash_key, None)
-            range_val = value.get(self.range_key, '')
-
-            if hash_val is None:
-                raise ValueError('Underlying DynamoDB table requires the hash key "%s" to be present in the value dictionary' % self.hash_key)
-
-            if self.KEY_SEPARATOR in str(hash_val):
-                raise ValueError('Hash key "%s" should not contain key seperator: "%s"' % (self.hash_key, self.KEY_SEPARATOR))
-
-            if self.range_key == Doc.key:
-                # PK is (hash_key, Key)
-                # Key name needs to be hash_key.rest_of_key
-                if not key.name.startswith(str(hash_val)):
-                    raise ValueError('Underlying DynamoDB table requires key name to be %s.[...], was %s while %s == %s' % (self.hash_key, key.name, self.hash_key, str(hash_val)))
-            else:
-                # PK is (hash_key, range_key) != (hash_key, Key)
-                # Key name needs to be hash_key.range_key
-                if key.name != str(hash_val) + self.KEY_SEPARATOR + str(range_val):
-                    raise ValueError('Underlying DynamoDB table requires key name to be %s.%s (%s.%s) was %s' % (self.hash_key, self.range_key, str(hash_val), str(range_val), key.name))
-        elif self.hash_key != Doc.key:
-            # PK is (hash_key) != (Key)
-            # Key name then has to be hash_key
-            if type(value) != dict or key.name != str(value.get(self.hash_key, '')):
-                raise ValueError('Underlying DynamoDB table requires key name to be %s, was %s' % (self.hash_key, key.name))
+        self.codec.validate(key, value)
 
     def primary_key_from_value(self, value):
         if self.range_key:
@@ -376,49 +1196,70 @@ class DynamoTable(Table):
         '''Returns the Dynamo primary key for the datastore key,
         depending on the schema of the underlying Dynamo table.
         '''
-        hash_key, range_key = None, None
-
-        if self.range_key:
-            # When a range key is specified, the hash key is everything before the separator
-            hash_key = key.name.split(self.KEY_SEPARATOR)[0]
-            if self.range_key == Doc.key:
-                # The range key is the full Key
-                range_key = str(key)
-            else:
-                # The range key is the part after the separator
-                range_key = key.name.split(self.KEY_SEPARATOR)[1]
-        elif self.hash_key != Doc.key:
-            # The entire key name
-            hash_key = key.name
-        else:
-            hash_key = str(key)
-
-        # Cast to correct types
-        try:
-            primary_key = {self.hash_key: self.datatypes[self.hash_key](hash_key)}
-            if self.range_key:
-                primary_key[self.range_key] = self.datatypes[self.range_key](range_key)
-        except InvalidOperation:
-            raise Exception('Invalid key format for datastore: %s' % key)
+        return self.codec.encode(key)
 
-        return primary_key
+    def primary_keys_from_keys(self, keys):
+        '''Returns the Dynamo primary keys for the datastore keys, in order.'''
+        return self.codec.encode_many(keys)
 
 
 class DynamoCursor(datastore.Cursor):
-    def __init__(self, query, iterable):
+    def __init__(self, query, iterable, table=None, index=None, limit=None):
         super(DynamoCursor, self).__init__(query, iterable)
+        self.index = index
+        self.limit = limit
+
+        # Key attributes DynamoDB needs to resume after an item on this index
+        self._key_attrs = table.keys if table else []
+        if index:
+            self._key_attrs = sorted(set(self._key_attrs + [k for k in [index.hash_key, index.range_key] if k]))
+        self._resume_key = None
+        self._current_key = None
+        self._exhausted = False
+
         self._orig_iterable = self._iterable
         self._iterable = self.unwrap_gen(self._iterable)
 
     def unwrap_gen(self, iterable):
         for item in iterable:
+            if self._key_attrs:
+                self._resume_key = dict((k, item._data.get(k)) for k in self._key_attrs)
+            self._current_key = item._data.get(Doc.key, None)
             yield DynamoDatastore._unwrap(item._data)
 
+        # Stopping at a limit may leave results in the page just fetched
+        results = getattr(iterable, '_results', [])
+        self._exhausted = not getattr(iterable, '_results_left', True) \
+            and getattr(iterable, '_offset', 0) >= len(results)
+
+    @property
+    def current_key(self):
+        '''Returns the datastore key (as a string) of the item last read.'''
+        return self._current_key
+
+    @property
+    def index_name(self):
+        return self.index.name if self.index else None
+
     @property
     def last_key(self):
         #return self._orig_iterable.last_evaluated_key
         return self._orig_iterable._last_key_seen
 
+    @property
+    def resume_key(self):
+        '''Returns the start key for the page following the last item read,
+        or None if the cursor was exhausted.
+        '''
+        if self._exhausted:
+            return None
+        return self._resume_key or self.last_key
+
+    def page_token(self, secret=None):
+        '''Returns an encoded PageToken to resume after this cursor, or None.'''
+        token = PageToken.from_cursor(self)
+        return token.encode(secret) if token else None
+
     '''
     
     def next(self):
@@ -451,25 +1292,62 @@ class DynamoQuery(object):
         return next(range_matches, None) or (hash_matches or [None])[0]
 
     @classmethod
-    def translate(cls, table, query):
-        '''Translate given datastore `query` to a mongodb query on `table`.'''
+    def translate(cls, table, query, consistent=False, token=None, attributes=None,
+                  segment=None, total_segments=None):
+        '''Translate given datastore `query` to a mongodb query on `table`.
+        `consistent` reads only apply to queries on the table or a local index:
+        DynamoDB does not support them on global indexes, and boto not on scans.
+        A PageToken `token` resumes the query where an earlier cursor left off.
+        Only `attributes` are fetched when given, and a scan can be restricted
+        to one `segment` out of `total_segments` of a parallel scan.
+        '''
 
         # If we're looking at a specific hash key, we can query instead of scan
         idx = cls.index_for_query(table, query)
         kwargs = cls.query_arguments(table, query, index=idx)
+        if token:
+            if token.index != (idx.name if idx else None):
+                raise ValueError('Page token for index %s does not match query on index %s' % (token.index, idx.name if idx else None))
+            kwargs['exclusive_start_key'] = token.last_key
+            if 'limit' not in kwargs and token.limit:
+                kwargs['limit'] = token.limit
+        if attributes:
+            kwargs['attributes'] = attributes
         if idx:
             if idx.name:
                 kwargs['index'] = idx.name
+            if consistent and idx.index_type != 'global':
+                kwargs['consistent'] = True
             datastore_cursor = table.query(**kwargs)
         else:
+            if total_segments:
+                kwargs['segment'] = segment
+                kwargs['total_segments'] = total_segments
             datastore_cursor = table.scan(**kwargs)
     
         # create datastore Cursor with query and iterable of results
-        cursor = DynamoCursor(query, datastore_cursor)
-        cursor.apply_filter()
+        cursor = DynamoCursor(query, datastore_cursor, table=table, index=idx, limit=kwargs.get('limit'))
+        if table.encoding == Encoding.native:
+            # Filters may target nested paths, which the default getter can't follow
+            cursor._iterable = Filter.filter([cls.path_filter(f) for f in query.filters], cursor._iterable)
+        else:
+            cursor.apply_filter()
         cursor.apply_order()
         return cursor
 
+    @classmethod
+    def path_filter(cls, filter):
+        '''Returns a copy of `filter` that resolves dotted fields into nested values.'''
+        path_filter = copy(filter)
+        path_filter.object_getattr = cls.path_getattr
+        return path_filter
+
+    @staticmethod
+    def path_getattr(obj, field):
+        for part in field.split(FilterExpression.PATH_SEPARATOR):
+            obj = obj.get(part, None) if isinstance(obj, dict) else None
+        return obj
+
     @classmethod
     def query_arguments(cls, table, query, index=None):
         filter_dict = {f.field: f for f in query.filters}
@@ -480,6 +1358,11 @@ class DynamoQuery(object):
             
             query_filters = [f for (field,f) in filter_dict.items() if field in [index.hash_key, index.range_key]]
             kwargs = cls.conditions(query_filters)
+        elif table.encoding == Encoding.native:
+            # must call scan, filtering natively typed and nested values server-side
+            kwargs = {}
+            if query.filters:
+                kwargs['filter_expression'] = cls.filter_expression(query.filters, Encoding.native)
         else:
             # must call scan
             applicable_filters = query.filters
@@ -497,12 +1380,22 @@ class DynamoQuery(object):
         return kwargs
 
     @classmethod
-    def condition(cls, filter):
+    def condition(cls, filter, encoding=Encoding.json):
         '''Transform given `filter` into a dynamodb condition tuple.'''
-        wrapped_val = DynamoDatastore._wrap_value(filter.value)
+        wrapped_val = DynamoDatastore._wrap_value(filter.value, encoding)
         return ('%s__%s' % (filter.field, cls.operators[filter.op]), wrapped_val)
 
     @classmethod
-    def conditions(cls, filters):
+    def conditions(cls, filters, encoding=Encoding.json):
         '''Transform given `filters` into a dynamodb condition dictionary.'''
-        return dict([cls.condition(f) for f in filters])
+        return dict([cls.condition(f, encoding) for f in filters])
+
+    @classmethod
+    def filter_expression(cls, filters, encoding=Encoding.native):
+        '''Transform given `filters` into a FilterExpression. Dotted fields
+        (e.g. `address.city`) target values nested in maps.
+        '''
+        expression = FilterExpression()
+        for f in filters:
+            expression.add(f.field, f.op, DynamoDatastore._wrap_value(f.value, encoding))
+        return expression
@@ -0,0 +1,142 @@
+'''
+Micro-benchmarks of the per-operation key handling overhead, without DynamoDB.
+
+  python -m datastore.dynamo.bench [iterations]
+
+Times primary key conversion and wrapping for each table schema, comparing
+the compiled KeyCodec against the schema-inspecting conversion it replaced.
+'''
+
+import sys
+import timeit
+
+from decimal import Decimal, InvalidOperation
+
+from datastore.core import Key
+from . import Doc, DynamoDatastore, DynamoTable, DynamoTableIndex
+
+
+class LegacyTable(DynamoTable):
+    '''DynamoTable converting keys as before KeyCodec, for comparison.'''
+
+    def validate_key_for_value(self, key, value):
+        if self.range_key:
+            if type(value) != dict:
+                raise ValueError('Underlying DynamoDB table requires values to be a dictionary')
+
+            hash_val = value.get(self.hash_key, None)
+            range_val = value.get(self.range_key, '')
+
+            if hash_val is None:
+                raise ValueError('Underlying DynamoDB table requires the hash key "%s" to be present in the value dictionary' % self.hash_key)
+
+            if self.KEY_SEPARATOR in str(hash_val):
+                raise ValueError('Hash key "%s" should not contain key seperator: "%s"' % (self.hash_key, self.KEY_SEPARATOR))
+
+            if self.range_key == Doc.key:
+                if not key.name.startswith(str(hash_val)):
+                    raise ValueError('Invalid key %s' % key)
+            else:
+                if key.name != str(hash_val) + self.KEY_SEPARATOR + str(range_val):
+                    raise ValueError('Invalid key %s' % key)
+        elif self.hash_key != Doc.key:
+            if type(value) != dict or key.name != str(value.get(self.hash_key, '')):
+                raise ValueError('Invalid key %s' % key)
+
+    def primary_key_from_key(self, key):
+        hash_key, range_key = None, None
+
+        if self.range_key:
+            hash_key = key.name.split(self.KEY_SEPARATOR)[0]
+            if self.range_key == Doc.key:
+                range_key = str(key)
+            else:
+                range_key = key.name.split(self.KEY_SEPARATOR)[1]
+        elif self.hash_key != Doc.key:
+            hash_key = key.name
+        else:
+            hash_key = str(key)
+
+        try:
+            primary_key = {self.hash_key: self.datatypes[self.hash_key](hash_key)}
+            if self.range_key:
+                primary_key[self.range_key] = self.datatypes[self.range_key](range_key)
+        except InvalidOperation:
+            raise Exception('Invalid key format for datastore: %s' % key)
+
+        return primary_key
+
+
+class LegacyDatastore(DynamoDatastore):
+
+    @staticmethod
+    def _should_pickle(key, val):
+        return not key in [Doc.key, Doc.hashkey, Doc.wrapped, Doc._id]
+
+    @staticmethod
+    def _wrap(table, key, value):
+        encoding = table.encoding
+
+        if not isinstance(value, dict):
+            wrapped = {Doc.value:DynamoDatastore._wrap_value(value, encoding), Doc.wrapped:True}
+        else:
+            wrapped = dict( (k, DynamoDatastore._wrap_value(v, encoding)) for (k,v) in value.iteritems() if LegacyDatastore._should_pickle(k,v) )
+
+        if table.hash_key == Doc.hashkey:
+            pk = table.primary_key_from_key(key)
+            wrapped[Doc.hashkey] = pk[table.hash_key]
+        table.validate_key_for_value(key, wrapped)
+
+        wrapped[Doc.key] = str(key)
+
+        return wrapped
+
+
+def fake_table(cls=DynamoTable, hash_key=Doc.key, range_key=None, datatypes=None, connection=None, **kwargs):
+    '''Returns a `cls` table with the given schema, as if prepared, without DynamoDB.'''
+    table = cls('test', connection=connection or object(), **kwargs)
+    table._main_index = DynamoTableIndex(None, hash_key, range_key, None)
+    table._datatypes = datatypes or {hash_key: str}
+    table._indices = {hash_key: [table._main_index]}
+    return table
+
+
+# (name, hash key, range key, datatypes, key, value)
+SCHEMAS = [
+    ('key', Doc.key, None, {Doc.key: str},
+        Key('/users/alice'), {'name': 'Alice', 'age': 30}),
+    ('hash', 'user', None, {'user': str},
+        Key('/users/alice'), {'user': 'alice', 'age': 30}),
+    ('partition.key', Doc.hashkey, Doc.key, {Doc.hashkey: str, Doc.key: str},
+        Key('/messages/alice.1'), {'text': 'hi', 'age': 30}),
+    ('hash.range', 'user', 'seq', {'user': str, 'seq': Decimal},
+        Key('/messages/alice.1'), {'user': 'alice', 'seq': 1, 'text': 'hi'}),
+]
+
+
+def timed(fn, iterations):
+    '''Returns the mean microseconds per call of `fn`, best of three.'''
+    return min(timeit.repeat(fn, number=iterations, repeat=3)) / iterations * 1e6
+
+
+def run(iterations=20000):
+    print '%-14s %-20s %9s %9s %8s' % ('schema', 'operation', 'before', 'after', 'speedup')
+    for (name, hash_key, range_key, datatypes, key, value) in SCHEMAS:
+        old = fake_table(LegacyTable, hash_key, range_key, datatypes)
+        new = fake_table(DynamoTable, hash_key, range_key, datatypes)
+        keys = [key] * 25
+
+        operations = [
+            ('primary_key', lambda: old.primary_key_from_key(key), lambda: new.primary_key_from_key(key)),
+            ('primary_keys (25)', lambda: [old.primary_key_from_key(k) for k in keys],
+                                  lambda: new.primary_keys_from_keys(keys)),
+            ('wrap', lambda: LegacyDatastore._wrap(old, key, value), lambda: DynamoDatastore._wrap(new, key, value)),
+        ]
+        for (op, before, after) in operations:
+            assert before() == after()
+            b, a = timed(before, iterations), timed(after, iterations)
+            print '%-14s %-20s %7.2fus %7.2fus %7.2fx' % (name, op, b, a, b / a)
+
+
+if __name__ == '__main__':
+    run(*map(int, sys.argv[1:]))
@@ -0,0 +1,41 @@
+'''
+Helpers for bulk operations spread over several worker threads.
+'''
+
+import threading
+import time
+
+
+class RateLimiter(object):
+    '''A token bucket shared by worker threads, allowing `rate` units per second.
+
+      >>> limiter = RateLimiter(100)
+      >>> limiter.acquire(25)   # blocks until 25 units may be spent
+
+    A `rate` of None never blocks.
+    '''
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self, units=1):
+        '''Blocks until `units` may be spent, then spends them.'''
+        if self.rate is None:
+            return
+
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+
+                # Requests larger than the burst may go once the bucket is full
+                if self._tokens >= min(units, self.burst):
+                    self._tokens -= units
+                    return
+                wait = (min(units, self.burst) - self._tokens) / float(self.rate)
+            time.sleep(wait)
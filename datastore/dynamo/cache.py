@@ -0,0 +1,191 @@
+'''
+A size-bounded item cache in a file shared by all processes on a host.
+
+The cache is an embedded SQLite database in WAL mode, so that many processes
+can read concurrently while one writes. It stores opaque item bytes with a
+time-to-live, and evicts the least recently used items past `max_bytes`.
+
+Writers `invalidate` keys rather than just deleting them. That bumps the
+key's generation and leaves a tombstone for `tombstone` seconds, so that
+readers can't put back a value they read before the write (it has an older
+generation), nor one read from a replica that hasn't seen the write yet.
+'''
+
+import os
+import sqlite3
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+class SharedItemCache(object):
+    '''Caches item bytes in the SQLite file at `path`, across processes.
+
+      >>> cache = SharedItemCache('/tmp/dynamo-cache.db', max_bytes=256 << 20, ttl=30)
+      >>> ds = DynamoDatastore(conn, cache=cache)
+
+    '''
+    # Don't rewrite an item's access time on every hit
+    TOUCH_INTERVAL = 1.0
+    EVICT_BATCH = 64
+
+    # Forget generations long after any read that started before them ended
+    GENERATION_TTL = 3600
+
+    def __init__(self, path, max_bytes=256 << 20, ttl=60, timeout=5, tombstone=5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.timeout = timeout
+        self.tombstone = tombstone
+
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+        self.hits = 0
+        self.misses = 0
+
+        with self._lock:
+            with self._transaction() as conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS items ('
+                             'key TEXT PRIMARY KEY, data BLOB, size INTEGER, expires REAL, accessed REAL)')
+                conn.execute('CREATE INDEX IF NOT EXISTS items_accessed ON items (accessed)')
+                conn.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)')
+                conn.execute("INSERT OR IGNORE INTO meta VALUES ('bytes', 0)")
+                conn.execute('CREATE TABLE IF NOT EXISTS generations ('
+                             'key TEXT PRIMARY KEY, generation INTEGER, written REAL)')
+                conn.execute('CREATE INDEX IF NOT EXISTS generations_written ON generations (written)')
+
+    def _connection(self):
+        # SQLite connections must not be shared with forked children
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                         isolation_level=None, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._pid = os.getpid()
+        return self._conn
+
+    @contextmanager
+    def _transaction(self):
+        '''Runs a write transaction, holding the database write lock throughout.'''
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    @property
+    def stats(self):
+        '''Returns this process's hits and misses on the shared cache.'''
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+        }
+
+    @property
+    def size(self):
+        '''Returns the number of bytes held in the cache.'''
+        with self._lock:
+            return self._connection().execute("SELECT value FROM meta WHERE name = 'bytes'").fetchone()[0]
+
+    def get(self, key):
+        '''Returns the bytes cached for `key`, or None.'''
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute('SELECT data, expires, accessed FROM items WHERE key = ?', (key,)).fetchone()
+
+            if row is None or row[1] < now:
+                self.misses += 1
+                return None
+
+            if now - row[2] > self.TOUCH_INTERVAL:
+                try:
+                    with self._transaction():
+                        conn.execute('UPDATE items SET accessed = ? WHERE key = ?', (now, key))
+                except sqlite3.OperationalError:
+                    pass # busy: the access time is only an eviction hint
+
+            self.hits += 1
+            return str(row[0])
+
+    def generation(self, key):
+        '''Returns the generation of `key`, to pass to `put` after reading it.'''
+        with self._lock:
+            row = self._connection().execute('SELECT generation FROM generations WHERE key = ?', (key,)).fetchone()
+            return row[0] if row else 0
+
+    def put(self, key, data, ttl=None, generation=None):
+        '''Caches `data` bytes for `key`, for `ttl` (or the default) seconds.
+        With a `generation`, only caches `data` if `key` was not invalidated
+        since, nor within the last `tombstone` seconds. Returns whether it did.
+        '''
+        now = time.time()
+        expires = now + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            with self._transaction() as conn:
+                if generation is not None:
+                    row = conn.execute('SELECT generation, written FROM generations WHERE key = ?', (key,)).fetchone()
+                    if row and (row[0] != generation or row[1] > now - self.tombstone):
+                        return False
+                self._remove(conn, key)
+                conn.execute('INSERT INTO items VALUES (?, ?, ?, ?, ?)',
+                             (key, sqlite3.Binary(data), len(data), expires, now))
+                conn.execute("UPDATE meta SET value = value + ? WHERE name = 'bytes'", (len(data),))
+                self._evict(conn, now)
+        return True
+
+    def invalidate(self, key):
+        '''Removes `key` from the cache after a write, bumping its generation.'''
+        now = time.time()
+        with self._lock:
+            with self._transaction() as conn:
+                self._remove(conn, key)
+                conn.execute('INSERT OR REPLACE INTO generations VALUES (?, '
+                             'COALESCE((SELECT generation FROM generations WHERE key = ?), 0) + 1, ?)',
+                             (key, key, now))
+
+    def delete(self, key):
+        '''Removes `key` from the cache.'''
+        with self._lock:
+            with self._transaction() as conn:
+                self._remove(conn, key)
+
+    def _remove(self, conn, key):
+        row = conn.execute('SELECT size FROM items WHERE key = ?', (key,)).fetchone()
+        if row:
+            conn.execute('DELETE FROM items WHERE key = ?', (key,))
+            conn.execute("UPDATE meta SET value = value - ? WHERE name = 'bytes'", (row[0],))
+
+    def _evict(self, conn, now):
+        '''Evicts expired, then least recently used, items while over `max_bytes`.'''
+        conn.execute('DELETE FROM generations WHERE written < ?', (now - self.GENERATION_TTL,))
+
+        total = conn.execute("SELECT value FROM meta WHERE name = 'bytes'").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        expired = conn.execute('SELECT COALESCE(SUM(size), 0) FROM items WHERE expires < ?', (now,)).fetchone()[0]
+        if expired:
+            conn.execute('DELETE FROM items WHERE expires < ?', (now,))
+            total -= expired
+
+        while total > self.max_bytes:
+            rows = conn.execute('SELECT key, size FROM items ORDER BY accessed LIMIT ?', (self.EVICT_BATCH,)).fetchall()
+            if not rows:
+                break
+            for (key, size) in rows:
+                if total <= self.max_bytes:
+                    break
+                conn.execute('DELETE FROM items WHERE key = ?', (key,))
+                total -= size
+
+        conn.execute("UPDATE meta SET value = ? WHERE name = 'bytes'", (total,))
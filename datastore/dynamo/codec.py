@@ -0,0 +1,137 @@
+'''
+Conversion between datastore keys and DynamoDB primary keys, compiled per table.
+
+How a datastore key maps onto a primary key depends on the table's schema
+(see DynamoTable.primary_key_from_key). Rather than inspect the schema on
+every call, KeyCodec picks the conversion for the schema once, when the table
+is prepared, so that each call splits the key name at most once and only
+casts the attributes that need it.
+'''
+
+from decimal import InvalidOperation
+from operator import itemgetter
+
+
+def key_name(key):
+    '''Returns `key.name`, without building the key's list of namespaces.'''
+    return str(key).rpartition('/')[2].rpartition(':')[2]
+
+
+class KeyCodec(object):
+    '''Converts keys for a table with `hash_key` and `range_key` attributes
+    of `datatypes`, where `key_attribute` holds the full datastore key.
+
+      >>> codec = KeyCodec('user', 'key', {'user': str, 'key': str})
+      >>> codec.encode(Key('/messages/alice.1'))
+      {'user': 'alice', 'key': '/messages/alice.1'}
+
+    '''
+
+    def __init__(self, hash_key, range_key, datatypes, key_attribute='key', separator='.'):
+        self.hash_key = hash_key
+        self.range_key = range_key
+        self.key_attribute = key_attribute
+        self.separator = separator
+        self.keys = tuple(k for k in (hash_key, range_key) if k is not None)
+
+        datatypes = datatypes or {}
+        self.encode = self._compile_encode(self._cast(datatypes.get(hash_key)),
+                                           self._cast(datatypes.get(range_key)))
+        self.validate = self._compile_validate()
+
+        # Extracts the primary key from an item (e.g. a cursor's resume key)
+        getter = itemgetter(*self.keys) if self.keys else None
+        if range_key is None:
+            self.project = lambda item: {hash_key: getter(item)}
+        else:
+            self.project = lambda item: dict(zip(self.keys, getter(item)))
+
+    def __repr__(self):
+        return 'KeyCodec(%r, %r)' % (self.hash_key, self.range_key)
+
+    @staticmethod
+    def _cast(datatype):
+        # Key name parts are already strings
+        return None if datatype in (None, str) else datatype
+
+    def _compile_encode(self, hash_cast, range_cast):
+        hash_key, range_key, sep = self.hash_key, self.range_key, self.separator
+
+        if range_key is None and hash_key == self.key_attribute:
+            # PK is (Key)
+            encode = lambda key: {hash_key: str(key)}
+        elif range_key is None:
+            # PK is (hash_key): the entire key name
+            encode = lambda key: {hash_key: key_name(key)}
+        elif range_key == self.key_attribute:
+            # PK is (hash_key, Key): the key name up to the separator, and the Key
+            def encode(key):
+                return {hash_key: key_name(key).split(sep, 1)[0], range_key: str(key)}
+        else:
+            # PK is (hash_key, range_key): the key name parts around the separator
+            def encode(key):
+                parts = key_name(key).split(sep)
+                return {hash_key: parts[0], range_key: parts[1]}
+
+        if not hash_cast and not range_cast:
+            return encode
+
+        def encode_cast(key):
+            primary_key = encode(key)
+            try:
+                if hash_cast:
+                    primary_key[hash_key] = hash_cast(primary_key[hash_key])
+                if range_cast:
+                    primary_key[range_key] = range_cast(primary_key[range_key])
+            except InvalidOperation:
+                raise Exception('Invalid key format for datastore: %s' % key)
+            return primary_key
+        return encode_cast
+
+    def _compile_validate(self):
+        hash_key, range_key, sep = self.hash_key, self.range_key, self.separator
+
+        if range_key is None and hash_key == self.key_attribute:
+            # Any key will do
+            return lambda key, value: None
+
+        if range_key is None:
+            # PK is (hash_key) != (Key): key name has to be hash_key
+            def validate(key, value):
+                if type(value) != dict or key_name(key) != str(value.get(hash_key, '')):
+                    raise ValueError('Underlying DynamoDB table requires key name to be %s, was %s' % (hash_key, key.name))
+            return validate
+
+        def validate(key, value):
+            if type(value) != dict:
+                raise ValueError('Underlying DynamoDB table requires values to be a dictionary')
+
+            hash_val = value.get(hash_key, None)
+            if hash_val is None:
+                raise ValueError('Underlying DynamoDB table requires the hash key "%s" to be present in the value dictionary' % hash_key)
+
+            hash_val = str(hash_val)
+            if sep in hash_val:
+                raise ValueError('Hash key "%s" should not contain key seperator: "%s"' % (hash_key, sep))
+
+            name = key_name(key)
+            if range_key == self.key_attribute:
+                # PK is (hash_key, Key): key name needs to be hash_key.rest_of_key
+                if not name.startswith(hash_val):
+                    raise ValueError('Underlying DynamoDB table requires key name to be %s.[...], was %s while %s == %s' % (hash_key, name, hash_key, hash_val))
+            else:
+                # PK is (hash_key, range_key): key name needs to be hash_key.range_key
+                range_val = str(value.get(range_key, ''))
+                if name != hash_val + sep + range_val:
+                    raise ValueError('Underlying DynamoDB table requires key name to be %s.%s (%s.%s) was %s' % (hash_key, range_key, hash_val, range_val, name))
+        return validate
+
+    def encode_many(self, keys):
+        '''Returns the primary keys for `keys`, in order.'''
+        encode = self.encode
+        return [encode(key) for key in keys]
+
+    def project_many(self, items):
+        '''Returns the primary keys of `items`, in order.'''
+        project = self.project
+        return [project(item) for item in items]
@@ -0,0 +1,90 @@
+'''
+DynamoDB filter expressions, for filters boto's legacy ScanFilter can't express:
+nested attribute paths (`address.city`) and native map, list and boolean values.
+'''
+
+
+class FilterExpression(object):
+    '''Builds a FilterExpression from datastore filter conditions.
+
+      >>> expr = FilterExpression()
+      >>> expr.add('address.city', '=', 'Amsterdam')
+      >>> expr.expression
+      '#n0.#n1 = :v0'
+
+    '''
+    PATH_SEPARATOR = '.'
+    operators = { '>':'>', '>=':'>=', '=':'=', '!=':'<>', '<=':'<=', '<':'<' }
+
+    def __init__(self):
+        self.terms = []
+        self.names = {}
+        self.values = {}
+
+    def __nonzero__(self):
+        return bool(self.terms)
+
+    def __repr__(self):
+        return 'FilterExpression(%r)' % self.expression
+
+    @property
+    def expression(self):
+        return ' AND '.join(self.terms)
+
+    def _name(self, name):
+        for (placeholder, existing) in self.names.iteritems():
+            if existing == name:
+                return placeholder
+
+        placeholder = '#n%d' % len(self.names)
+        self.names[placeholder] = name
+        return placeholder
+
+    def path(self, field):
+        '''Returns the (placeholder) document path for a dotted `field`.'''
+        return '.'.join(self._name(part) for part in field.split(self.PATH_SEPARATOR))
+
+    def add(self, field, op, value):
+        '''Adds the condition `field op value`, ANDed with existing ones.'''
+        placeholder = ':v%d' % len(self.values)
+        self.values[placeholder] = value
+        self.terms.append('%s %s %s' % (self.path(field), self.operators[op], placeholder))
+
+    def arguments(self, dynamizer, attributes=None):
+        '''Returns the request arguments, with values encoded by `dynamizer`.
+        Requests can't mix expressions with AttributesToGet, so `attributes`
+        to fetch become a ProjectionExpression.
+        '''
+        names = dict(self.names)
+        arguments = {
+            'filter_expression': self.expression,
+            'expression_attribute_names': names,
+            'expression_attribute_values': dict((k, dynamizer.encode(v)) for (k, v) in self.values.iteritems()),
+        }
+
+        if attributes:
+            projection = []
+            for (i, attr) in enumerate(attributes):
+                names['#p%d' % i] = attr
+                projection.append('#p%d' % i)
+            arguments['projection_expression'] = ', '.join(projection)
+        return arguments
+
+
+class ExpressionConnection(object):
+    '''Wraps a DynamoDB connection, adding filter expression arguments to its
+    scan requests. DynamoDB does not allow mixing expressions with the legacy
+    ScanFilter, so that is dropped.
+    '''
+
+    def __init__(self, conn, arguments):
+        self.conn = conn
+        self.arguments = arguments
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def scan(self, table_name, **kwargs):
+        kwargs.pop('scan_filter', None)
+        kwargs.update(self.arguments)
+        return self.conn.scan(table_name, **kwargs)
@@ -0,0 +1,194 @@
+'''
+Hedged reads: duplicate slow reads onto alternate connections.
+
+A read is first sent on the primary connection. If it has not answered within
+the hedge delay, the same read is sent on the next alternate connection, and
+whichever answers first wins. Hedges are paid for from a budget, so that they
+can only ever cost a bounded fraction of extra read capacity.
+'''
+
+import threading
+import time
+import Queue
+
+from collections import deque
+
+
+class WorkerPool(object):
+    '''Runs tasks on reused daemon threads, starting a thread only when none
+    is idle, so that a task never waits behind another. At most `max_idle`
+    threads are kept around between tasks.
+    '''
+
+    def __init__(self, max_idle=16):
+        self.max_idle = max_idle
+        self._tasks = Queue.Queue()
+        self._lock = threading.Lock()
+        self._idle = 0
+
+    def submit(self, task):
+        '''Runs the zero-argument callable `task` on a worker thread.'''
+        with self._lock:
+            start = self._idle == 0
+            if not start:
+                self._idle -= 1 # reserve an idle worker for this task
+
+        if start:
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+        self._tasks.put(task)
+
+    def _work(self):
+        while True:
+            self._tasks.get()()
+            with self._lock:
+                if self._idle >= self.max_idle:
+                    return
+                self._idle += 1
+
+
+class HedgedReads(object):
+    '''Issues hedged reads across a set of alternate connections.
+
+      >>> hedge = HedgedReads([conn_b, conn_c], delay=0.02, budget=0.05)
+      >>> ds = DynamoDatastore(conn_a, hedge=hedge)
+
+    `delay` is the fixed hedge delay in seconds. When `percentile` is given
+    (e.g. 95), the delay instead follows that percentile of the most recent
+    `window` read latencies, once at least `min_samples` have been seen.
+
+    `budget` is the fraction of read capacity that may be spent on hedges:
+    every read earns `budget` hedge tokens per item it reads (up to `burst`),
+    and every hedge spends one token per item it reads again. Hedges larger
+    than `burst` may go once the bucket is full.
+    '''
+    # Recompute the adaptive delay every this many reads
+    RECOMPUTE_EVERY = 50
+
+    def __init__(self, conns, delay=0.05, percentile=None, budget=0.05,
+                 burst=10, window=1000, min_samples=20):
+        self.conns = list(conns)
+        self.delay = delay
+        self.percentile = percentile
+        self.budget = budget
+        self.burst = burst
+        self.min_samples = min_samples
+
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._workers = WorkerPool()
+
+        self._percentile_delay = None
+        self._new_samples = 0
+
+        self.reads = 0
+        self.hedged = 0
+        self.hedged_units = 0
+        self.hedge_wins = 0
+        self.budget_denied = 0
+
+    @property
+    def stats(self):
+        '''Returns counters on how often hedging triggered and paid off.'''
+        delay = self.hedge_delay()
+        with self._lock:
+            return {
+                'reads': self.reads,
+                'hedged': self.hedged,
+                'hedged_units': self.hedged_units,
+                'hedge_wins': self.hedge_wins,
+                'budget_denied': self.budget_denied,
+                'hedge_rate': float(self.hedged) / self.reads if self.reads else 0.0,
+                'delay': delay,
+            }
+
+    def hedge_delay(self):
+        '''Returns the number of seconds to wait before hedging a read.'''
+        if self.percentile is None:
+            return self.delay
+
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return self.delay
+
+            if self._percentile_delay is None or self._new_samples >= self.RECOMPUTE_EVERY:
+                latencies = sorted(self._latencies)
+                idx = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100.0))
+                self._percentile_delay = latencies[idx]
+                self._new_samples = 0
+            return self._percentile_delay
+
+    def _earn(self, cost):
+        with self._lock:
+            self.reads += 1
+            self._tokens = min(self.burst, self._tokens + self.budget * cost)
+
+    def _spend(self, cost):
+        with self._lock:
+            if self._tokens < min(cost, self.burst):
+                self.budget_denied += 1
+                return False
+            self._tokens -= cost
+            self.hedged += 1
+            self.hedged_units += cost
+            return True
+
+    def _launch(self, idx, call, results):
+        def run():
+            start = time.time()
+            try:
+                value = call()
+            except Exception, e:
+                results.put((idx, False, e))
+                return
+            with self._lock:
+                self._latencies.append(time.time() - start)
+                self._new_samples += 1
+            results.put((idx, True, value))
+
+        self._workers.submit(run)
+
+    def read(self, calls, cost=1):
+        '''Runs the first of `calls` and hedges onto the next ones as needed.
+        `calls` are zero-argument callables performing the same read, primary
+        connection first, of `cost` items (e.g. the keys of a batch get).
+        Returns the value of the first call to succeed.
+        '''
+        self._earn(cost)
+
+        results = Queue.Queue()
+        self._launch(0, calls[0], results)
+        launched, errors = 1, []
+
+        while True:
+            if len(errors) == launched:
+                # Every read in flight failed: fail over if we still can.
+                if launched < len(calls) and self._spend(cost):
+                    self._launch(launched, calls[launched], results)
+                    launched += 1
+                else:
+                    raise errors[0]
+
+            can_hedge = launched < len(calls)
+            try:
+                # Queue.get without a timeout can't be interrupted; poll instead.
+                timeout = self.hedge_delay() if can_hedge else 3600
+                idx, ok, value = results.get(timeout=timeout)
+            except Queue.Empty:
+                if can_hedge and self._spend(cost):
+                    self._launch(launched, calls[launched], results)
+                    launched += 1
+                elif can_hedge:
+                    # Out of budget: stop trying to hedge this read.
+                    calls = calls[:launched]
+                continue
+
+            if ok:
+                if idx > 0:
+                    with self._lock:
+                        self.hedge_wins += 1
+                return value
+
+            errors.append(value)
@@ -0,0 +1,111 @@
+'''
+Opaque pagination tokens, so a query can be resumed statelessly.
+
+A token carries the DynamoDB start key of the next page (with the type of
+every key attribute), the index the query ran on, and the page size. It is
+compact urlsafe base64, optionally followed by an HMAC-SHA256 signature.
+'''
+
+import base64
+import hashlib
+import hmac
+import json
+
+from decimal import Decimal
+
+
+class PageToken(object):
+    '''Resumes a query where a cursor left off.
+
+      >>> token = PageToken.from_cursor(cursor).encode(secret)
+      >>> # ... later, possibly in another process:
+      >>> ds.query(query, token=PageToken.decode(token, secret))
+
+    '''
+    VERSION = 1
+    SIGNATURE_BYTES = 16
+
+    def __init__(self, last_key, index=None, limit=None):
+        self.last_key = last_key
+        self.index = index
+        self.limit = limit
+
+    def __repr__(self):
+        return 'PageToken(%r, %r, %r)' % (self.last_key, self.index, self.limit)
+
+    def __eq__(self, other):
+        return isinstance(other, PageToken) and \
+            (self.last_key, self.index, self.limit) == (other.last_key, other.index, other.limit)
+
+    def __ne__(self, other):
+        return not self == other
+
+    @classmethod
+    def from_cursor(cls, cursor):
+        '''Returns the token for the page after `cursor`, or None if it is exhausted.'''
+        last_key = cursor.resume_key
+        if last_key is None:
+            return None
+        return cls(last_key, index=cursor.index_name, limit=cursor.limit)
+
+    @staticmethod
+    def _encode_value(value):
+        if isinstance(value, basestring):
+            return ['S', value]
+        elif isinstance(value, (Decimal, int, long)):
+            return ['N', str(value)]
+        raise ValueError('Unsupported key attribute type for page token: %r' % value)
+
+    @staticmethod
+    def _decode_value(value):
+        dtype, value = value
+        if dtype == 'S':
+            return value
+        elif dtype == 'N':
+            return Decimal(value)
+        raise ValueError('Unsupported key attribute type in page token: %s' % dtype)
+
+    @staticmethod
+    def _b64encode(data):
+        return base64.urlsafe_b64encode(data).rstrip('=')
+
+    @staticmethod
+    def _b64decode(data):
+        return base64.urlsafe_b64decode(str(data) + '=' * (-len(data) % 4))
+
+    @classmethod
+    def _signature(cls, body, secret):
+        digest = hmac.new(secret, body, hashlib.sha256).digest()
+        return cls._b64encode(digest[:cls.SIGNATURE_BYTES])
+
+    def encode(self, secret=None):
+        '''Returns this token as a string, signed when a `secret` is given.'''
+        last_key = dict((k, self._encode_value(v)) for (k, v) in self.last_key.iteritems())
+        payload = [self.VERSION, last_key, self.index, self.limit]
+        body = self._b64encode(json.dumps(payload, separators=(',', ':'), sort_keys=True))
+
+        if secret is None:
+            return body
+        return body + '.' + self._signature(body, secret)
+
+    @classmethod
+    def decode(cls, token, secret=None):
+        '''Returns the PageToken encoded in `token`. When a `secret` is given,
+        the token must carry a valid signature.
+        '''
+        body, _, signature = str(token).partition('.')
+
+        if secret is not None:
+            if not hmac.compare_digest(signature, cls._signature(body, secret)):
+                raise ValueError('Invalid page token signature')
+
+        try:
+            version, last_key, index, limit = json.loads(cls._b64decode(body))
+        except (TypeError, ValueError):
+            raise ValueError('Malformed page token: %s' % token)
+
+        if version != cls.VERSION:
+            raise ValueError('Unsupported page token version: %s' % version)
+
+        last_key = dict((str(k), cls._decode_value(v)) for (k, v) in last_key.iteritems())
+        return cls(last_key, index=index, limit=limit)
@@ -0,0 +1,40 @@
+'''
+Consistent hashing of keys onto shards.
+'''
+
+import hashlib
+
+from bisect import bisect
+
+
+class HashRing(object):
+    '''Maps keys onto `shards` shards by consistent hashing.
+
+    Each shard owns `replicas` points on the ring, so that going from N to
+    N + 1 shards only moves about 1 / (N + 1) of the keys, all of them onto
+    the new shard.
+    '''
+
+    def __init__(self, shards, replicas=64):
+        if shards < 1:
+            raise ValueError('A hash ring needs at least one shard, got %s' % shards)
+
+        self.shards = shards
+        points = sorted((self._hash('%d:%d' % (shard, r)), shard)
+                        for shard in range(shards) for r in range(replicas))
+        self._points = [p for (p, _) in points]
+        self._owners = [s for (_, s) in points]
+
+    def __repr__(self):
+        return 'HashRing(%d)' % self.shards
+
+    @staticmethod
+    def _hash(name):
+        return int(hashlib.md5(name).hexdigest()[:16], 16)
+
+    def shard_for(self, name):
+        '''Returns the shard (0 <= shard < shards) owning `name`.'''
+        if self.shards == 1:
+            return 0
+        idx = bisect(self._points, self._hash(name)) % len(self._points)
+        return self._owners[idx]
@@ -0,0 +1,140 @@
+'''
+Item size accounting, following DynamoDB's item size rules.
+
+  http://docs.aws.amazon.com/amazondynamodb/latest/developerguide/CapacityUnitCalculations.html
+
+Sizes are computed on the values handed to boto (i.e. `_wrap` output), so
+that oversized items can be refused, and capacity estimated, before any
+request is made.
+'''
+
+import math
+import random
+import threading
+
+from collections import defaultdict
+from decimal import Decimal
+
+
+MAX_ITEM_SIZE = 400 * 1024
+READ_UNIT_SIZE = 4 * 1024
+WRITE_UNIT_SIZE = 1024
+
+# Lists and maps take 3 bytes, plus 1 byte per element
+CONTAINER_OVERHEAD = 3
+ELEMENT_OVERHEAD = 1
+
+
+class ItemTooLarge(ValueError):
+    '''Raised for items over DynamoDB's maximum item size.'''
+    pass
+
+
+def _utf8_size(value):
+    if isinstance(value, unicode):
+        return len(value.encode('utf-8'))
+    return len(value)
+
+
+def number_size(value):
+    '''Numbers take 1 byte per two significant digits, plus 1 byte.
+    Leading and trailing zeroes are not significant.
+    '''
+    if not isinstance(value, Decimal):
+        value = Decimal(repr(value) if isinstance(value, float) else value)
+    digits = len(value.normalize().as_tuple().digits)
+    return int(math.ceil(digits / 2.0)) + 1
+
+
+def value_size(value):
+    '''Returns the size in bytes DynamoDB accounts for attribute `value`.'''
+    if isinstance(value, basestring):
+        return _utf8_size(value)
+    elif value is None or isinstance(value, bool):
+        return 1
+    elif isinstance(value, (int, long, float, Decimal)):
+        return number_size(value)
+    elif isinstance(value, (set, frozenset)):
+        return sum(value_size(v) for v in value)
+    elif isinstance(value, (list, tuple)):
+        return CONTAINER_OVERHEAD + sum(value_size(v) + ELEMENT_OVERHEAD for v in value)
+    elif isinstance(value, dict):
+        return CONTAINER_OVERHEAD + sum(_utf8_size(k) + value_size(v) + ELEMENT_OVERHEAD
+                                        for (k, v) in value.iteritems())
+    # binary and anything else boto stores as bytes
+    return len(str(value))
+
+
+def item_size(item):
+    '''Returns the size in bytes of `item`: its attribute names and values.'''
+    return sum(_utf8_size(name) + value_size(value) for (name, value) in item.iteritems())
+
+
+def read_units(size, consistent=False):
+    '''Returns the read capacity units to read `size` bytes in one request.
+    Eventually consistent reads cost half.
+    '''
+    units = max(1, int(math.ceil(size / float(READ_UNIT_SIZE))))
+    return units if consistent else units / 2.0
+
+
+def write_units(size):
+    '''Returns the write capacity units to write an item of `size` bytes.'''
+    return max(1, int(math.ceil(size / float(WRITE_UNIT_SIZE))))
+
+
+class SizeSampler(object):
+    '''Records the distribution of item sizes per table, for a sampled
+    `rate` (0 < rate <= 1) of the items passed to `record`.
+    '''
+
+    def __init__(self, rate=0.01):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._tables = defaultdict(lambda: {'count': 0, 'bytes': 0, 'max': 0, 'histogram': defaultdict(int)})
+
+    @staticmethod
+    def bucket(size):
+        '''Returns the histogram bucket of `size`: the next power of two.'''
+        return 1 << max(0, int(size - 1).bit_length())
+
+    def record(self, table_name, size):
+        if self.rate < 1 and random.random() >= self.rate:
+            return
+
+        with self._lock:
+            stats = self._tables[table_name]
+            stats['count'] += 1
+            stats['bytes'] += size
+            stats['max'] = max(stats['max'], size)
+            stats['histogram'][self.bucket(size)] += 1
+
+    def mean(self, table_name):
+        '''Returns the mean sampled item size of `table_name`, or None.'''
+        with self._lock:
+            stats = self._tables.get(table_name, None)
+            return float(stats['bytes']) / stats['count'] if stats else None
+
+    def percentile(self, table_name, percentile):
+        '''Returns the histogram bucket holding the `percentile` item size.'''
+        with self._lock:
+            stats = self._tables.get(table_name, None)
+            if not stats:
+                return None
+
+            seen, wanted = 0, stats['count'] * percentile / 100.0
+            for bucket in sorted(stats['histogram']):
+                seen += stats['histogram'][bucket]
+                if seen >= wanted:
+                    return bucket
+
+    def stats(self):
+        '''Returns the sampled item size distribution of every table.'''
+        with self._lock:
+            tables = dict((name, dict(stats, histogram=dict(stats['histogram'])))
+                          for (name, stats) in self._tables.iteritems())
+        for (name, stats) in tables.iteritems():
+            stats['mean'] = float(stats['bytes']) / stats['count']
+            stats['p50'] = self.percentile(name, 50)
+            stats['p99'] = self.percentile(name, 99)
+        return tables
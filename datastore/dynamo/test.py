@@ -2,17 +2,30 @@
 
 import unittest
 import logging
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
 import boto
 import mock
 
 from . import *
+from .bench import fake_table
 from datastore.core.test.test_basic import TestDatastore
-from datastore.core.query import Query
+from datastore.core.query import Query, Filter
 from datastore.core.key import Key
 
+from boto.dynamodb2.items import Item
 from boto.dynamodb2.table import Table
 from boto.dynamodb2.fields import HashKey, RangeKey, KeysOnlyIndex, AllIndex, GlobalAllIndex
 from boto.dynamodb2.types import NUMBER, STRING
+from bson import ObjectId
+from decimal import Decimal
+from collections import Counter
+from functools import partial
 from math import floor
 
 aws_access_key = '<aws access key>'
@@ -24,6 +37,7 @@ try:
 except:
   pass
 
+
 class TestDynamoDatastore(TestDatastore):
 
   SIMPLE_TABLE = str(TestDatastore.pkey)[1:]
@@ -292,5 +306,779 @@ class TestDynamoDatastore(TestDatastore):
     del k
     del n
 
+
+class SlowConnection(object):
+  '''Fake connection that answers reads after an injected latency.'''
+
+  def __init__(self, name, latency=0, error=None):
+    self.name = name
+    self.latency = latency
+    self.error = error
+    self.calls = 0
+
+  def get_item(self, key):
+    self.calls += 1
+    time.sleep(self.latency)
+    if self.error:
+      raise self.error
+    return (self.name, key)
+
+
+class TestHedgedReads(unittest.TestCase):
+
+  def read(self, hedge, conns, key='abc'):
+    return hedge.read([partial(c.get_item, key) for c in conns])
+
+  def test_fast_primary_is_not_hedged(self):
+    primary, alt = SlowConnection('primary'), SlowConnection('alt')
+    hedge = HedgedReads([alt], delay=0.5, budget=1.0)
+
+    assert self.read(hedge, [primary, alt]) == ('primary', 'abc')
+    assert alt.calls == 0
+    assert hedge.stats['hedged'] == 0
+
+  def test_slow_primary_is_hedged(self):
+    primary, alt = SlowConnection('primary', 1.0), SlowConnection('alt')
+    hedge = HedgedReads([alt], delay=0.01, budget=1.0)
+
+    assert self.read(hedge, [primary, alt]) == ('alt', 'abc')
+    stats = hedge.stats
+    assert stats['reads'] == 1
+    assert stats['hedged'] == 1
+    assert stats['hedge_wins'] == 1
+
+  def test_budget_limits_hedging(self):
+    primary, alt = SlowConnection('primary', 0.05), SlowConnection('alt')
+    hedge = HedgedReads([alt], delay=0.01, budget=0.5)
+
+    results = [self.read(hedge, [primary, alt]) for _ in range(4)]
+    assert results.count(('alt', 'abc')) == 2, results
+    assert hedge.stats['hedged'] == 2
+    assert hedge.stats['budget_denied'] == 2
+
+  def test_budget_counts_items(self):
+    primary, slow, alt = SlowConnection('primary'), SlowConnection('primary', 0.2), SlowConnection('alt')
+    hedge = HedgedReads([alt], delay=0.01, budget=0.5, burst=100)
+    for _ in range(20):
+      self.read(hedge, [primary, alt])
+
+    # 10 tokens, plus 15 earned by the batch: not enough to read 30 items again
+    batch = lambda c: partial(c.get_item, 'batch')
+    assert hedge.read([batch(slow), batch(alt)], cost=30) == ('primary', 'batch')
+    assert hedge.stats['budget_denied'] == 1
+
+    assert hedge.read([batch(slow), batch(alt)], cost=20) == ('alt', 'batch')
+    assert hedge.stats['hedged_units'] == 20
+
+  def test_failed_primary_fails_over(self):
+    primary = SlowConnection('primary', error=ValueError('boom'))
+    alt = SlowConnection('alt')
+    hedge = HedgedReads([alt], delay=0.5, budget=1.0)
+    assert self.read(hedge, [primary, alt]) == ('alt', 'abc')
+
+    hedge = HedgedReads([alt], delay=0.5, budget=0)
+    self.assertRaises(ValueError, self.read, hedge, [primary, alt])
+
+  def test_adaptive_delay(self):
+    primary, alt = SlowConnection('primary', 0.02), SlowConnection('alt')
+    hedge = HedgedReads([alt], delay=10, percentile=50, budget=0, min_samples=5)
+
+    assert hedge.hedge_delay() == 10
+    for _ in range(5):
+      self.read(hedge, [primary, alt])
+    delay = hedge.hedge_delay()
+    assert 0.02 <= delay < 1
+
+    # the percentile is only recomputed every RECOMPUTE_EVERY reads
+    primary.latency = 0
+    for _ in range(HedgedReads.RECOMPUTE_EVERY - 1):
+      self.read(hedge, [primary, alt])
+    assert hedge.hedge_delay() == delay
+    self.read(hedge, [primary, alt])
+    assert hedge.hedge_delay() < delay
+
+  def test_reads_reuse_threads(self):
+    hedge = HedgedReads([], delay=10)
+    threads = set()
+    for _ in range(10):
+      hedge.read([lambda: threads.add(threading.current_thread().ident)])
+      time.sleep(0.01) # let the worker go back to idle
+    assert len(threads) == 1, threads
+    assert threading.current_thread().ident not in threads
+
+
+class TestDynamoSession(unittest.TestCase):
+
+  def setUp(self):
+    self.ds = DynamoDatastore(None)
+    tables = {'a': mock.Mock(table_name='a'), 'b': mock.Mock(table_name='b')}
+    self.ds._table = lambda key: tables[key.path.name]
+    self.ds.get = mock.Mock(return_value=None)
+    self.ds.put = mock.Mock()
+    self.ds.delete = mock.Mock()
+    self.ds.query = mock.Mock()
+
+  def consistent(self, method):
+    return method.call_args[1]['consistent']
+
+  def test_reads_own_writes(self):
+    session = self.ds.session(window=60)
+    written, other = Key('/a/written'), Key('/a/other')
+
+    session.get(written)
+    assert self.consistent(self.ds.get) is None
+
+    session.put(written, 'value')
+    session.get(written)
+    assert self.consistent(self.ds.get) is True
+    session.get(other)
+    assert self.consistent(self.ds.get) is None
+    session.get(written, consistent=False)
+    assert self.consistent(self.ds.get) is False
+
+    session.query(Query(Key('/a')))
+    assert self.consistent(self.ds.query) is True
+    session.query(Query(Key('/b')))
+    assert self.consistent(self.ds.query) is None
+
+  def test_get_many_splits_strong_reads(self):
+    session = self.ds.session(window=60)
+    written, other = Key('/a/written'), Key('/a/other')
+    self.ds.get_many = mock.Mock(side_effect=lambda keys, consistent=None: [str(k) for k in keys])
+
+    assert session.get_many([other]) == [str(other)]
+    assert self.ds.get_many.call_args == mock.call([other])
+
+    session.put(written, 'value')
+    self.ds.get_many.reset_mock()
+    assert session.get_many([other, written, other]) == [str(other), str(written), str(other)]
+    assert self.ds.get_many.call_args_list == [
+      mock.call([written], consistent=True), mock.call([other, other])]
+
+  def test_bulk_deletes(self):
+    session = self.ds.session(window=60)
+    self.ds.delete_query = mock.Mock(return_value={'deleted': 2})
+    assert session.truncate(Key('/a')) == {'deleted': 2}
+    assert self.ds.delete_query.call_args[0][0].key == Key('/a')
+
+    session.get(Key('/a/gone'))
+    assert self.consistent(self.ds.get) is True
+    session.query(Query(Key('/a')))
+    assert self.consistent(self.ds.query) is True
+    session.get(Key('/b/other'))
+    assert self.consistent(self.ds.get) is None
+
+  def test_sharded_queries(self):
+    ds = ShardedDynamoDatastore(None, shards={'users': 4})
+    ds._table_named = lambda name, key, conn=None, create=True: mock.Mock(table_name=name)
+    ds._put = mock.Mock()
+    ds.query = mock.Mock()
+    session = ds.session(window=60)
+
+    session.put(Key('/users/1'), 'value')
+    session.query(Query(Key('/users')))
+    assert self.consistent(ds.query) is True
+    session.query(Query(Key('/other')))
+    assert self.consistent(ds.query) is None
+
+  def test_window_expires(self):
+    session = self.ds.session(window=60)
+    key = Key('/b/deleted')
+    session.delete(key)
+    assert session.wrote_key(key)
+    assert session.wrote_table(key)
+
+    with mock.patch('time.time', return_value=time.time() + 61):
+      assert not session.wrote_key(key)
+      session.get(key)
+      assert self.consistent(self.ds.get) is None
+
+
+class TestPageToken(unittest.TestCase):
+
+  def test_round_trip(self):
+    token = PageToken({'department': u'sales', 'score': Decimal('1500.25')}, index='ScoreIndex', limit=10)
+    decoded = PageToken.decode(token.encode())
+    assert decoded == token, decoded
+    assert isinstance(decoded.last_key['score'], Decimal)
+    assert PageToken.decode(token.encode()).encode() == token.encode()
+
+  def test_signed(self):
+    token = PageToken({'key': '/a/b'}).encode('secret')
+    assert PageToken.decode(token, 'secret').last_key == {'key': '/a/b'}
+    self.assertRaises(ValueError, PageToken.decode, token, 'other')
+    self.assertRaises(ValueError, PageToken.decode, token.split('.')[0], 'secret')
+    self.assertRaises(ValueError, PageToken.decode, 'garbage')
+
+  def test_from_cursor(self):
+    table = mock.Mock(keys=['department', 'name'])
+    index = DynamoTableIndex('ScoreIndex', 'department', 'score', 'local')
+    items = [mock.Mock(_data={'department': 'sales', 'name': n, 'score': Decimal(s), 'key': n})
+             for (n, s) in [('Johnny', 1500), ('Tom', 1000)]]
+
+    cursor = DynamoCursor(Query(Key('/t')), iter(items), table=table, index=index, limit=1)
+    assert next(cursor) == {'department': 'sales', 'name': 'Johnny', 'score': 1500, 'key': 'Johnny'}
+
+    token = PageToken.decode(cursor.page_token())
+    assert token.index == 'ScoreIndex'
+    assert token.limit == 1
+    assert token.last_key == {'department': 'sales', 'name': 'Johnny', 'score': Decimal(1500)}
+
+  def test_translate_with_token(self):
+    table = mock.Mock(keys=['key'])
+    table.indices_for_hash_key.return_value = []
+    table.scan.return_value = iter([])
+    token = PageToken({'key': '/t/5'}, limit=5)
+
+    DynamoQuery.translate(table, Query(Key('/t')), token=token)
+    table.scan.assert_called_with(exclusive_start_key={'key': '/t/5'}, limit=5)
+
+    token = PageToken({'key': '/t/5'}, index='SomeIndex')
+    self.assertRaises(ValueError, DynamoQuery.translate, table, Query(Key('/t')), token=token)
+
+
+class TestHashRing(unittest.TestCase):
+
+  def test_spread_and_movement(self):
+    names = ['/users/%d' % i for i in range(2000)]
+    four, five = HashRing(4), HashRing(5)
+
+    counts = [0] * 4
+    for name in names:
+      counts[four.shard_for(name)] += 1
+    assert min(counts) > 300, counts
+
+    # growing to 5 shards only moves keys onto the new shard
+    moved = [n for n in names if four.shard_for(n) != five.shard_for(n)]
+    assert all(five.shard_for(n) == 4 for n in moved)
+    assert len(moved) < len(names) / 3, len(moved)
+
+    assert HashRing(1).shard_for('/users/1') == 0
+    self.assertRaises(ValueError, HashRing, 0)
+
+
+class TestShardedDynamoDatastore(unittest.TestCase):
+
+  def setUp(self):
+    self.ds = ShardedDynamoDatastore(None, shards={'users': 4}, prefix='p_')
+    self.tables = {}
+    def table_named(name, key, conn=None, create=True):
+      return self.tables.setdefault(name, mock.Mock(table_name=name, keys=['key']))
+    self.ds._table_named = table_named
+
+  def test_routing(self):
+    names = set(self.ds._table(Key('/users/%d' % i)).table_name for i in range(100))
+    assert names == set(['p_users', 'p_users-shard1', 'p_users-shard2', 'p_users-shard3']), names
+    assert self.ds._table(Key('/other/1')).table_name == 'p_other'
+
+    key = Key('/users/1')
+    with mock.patch.object(DynamoDatastore, '_put') as put:
+      self.ds.put(key, 'value')
+      put.assert_called_with(self.ds._table(key), key, 'value')
+    stats = self.ds.shard_stats()
+    assert stats[self.ds._table(key).table_name] == {'puts': 1}
+
+  def test_reads_fall_back_during_rebalance(self):
+    key = next(Key('/users/%d' % i) for i in range(100)
+      if HashRing(4).shard_for('/users/%d' % i) != HashRing(5).shard_for('/users/%d' % i))
+    old_table = self.ds._table(key)
+
+    self.ds.shards['users'] = 5
+    self.ds._migrating['users'] = 4
+    new_table = self.ds._table(key)
+    assert new_table is not old_table
+    new_table.batch_get.return_value = []
+
+    def get(table, key, consistent):
+      return 'value' if table is old_table else None
+    with mock.patch.object(DynamoDatastore, '_get', side_effect=get):
+      assert self.ds.get(key) == 'value'
+      assert self.ds.get_many([key]) == ['value']
+
+  def scan_items(self, keys):
+    '''Makes each shard table scan the items of `keys` it holds, in key order.'''
+    for table in set(self.ds._table(k) for k in keys):
+      items = [mock.MagicMock(_data={'key': str(k)}, __getitem__=lambda self, a, k=k: str(k))
+        for k in sorted(keys, key=str) if self.ds._table(k) is table]
+      def scan(exclusive_start_key=None, items=items):
+        start = (exclusive_start_key or {}).get('key', '')
+        return [i for i in items if i._data['key'] > start]
+      table.scan.side_effect = scan
+
+  def test_rebalance(self):
+    keys = [Key('/users/%d' % i) for i in range(50)]
+    self.scan_items(keys)
+
+    with mock.patch.object(DynamoDatastore, '_delete') as delete:
+      moved = self.ds.rebalance(Key('/users'), 5)['moved']
+    assert moved == len([k for k in keys if self.ds._table(k).table_name == 'p_users-shard4'])
+    assert moved == delete.call_count
+    assert self.ds.shard_stats()['p_users-shard4']['moved_in'] == moved
+    assert self.ds._table(keys[0], 5) is self.ds._table(keys[0])
+    assert not self.ds._migrating
+
+  def test_rebalance_resume(self):
+    keys = [Key('/users/%d' % i) for i in range(200)]
+    self.scan_items(keys)
+    expected = len([k for k in keys if HashRing(4).shard_for(str(k)) != HashRing(5).shard_for(str(k))])
+
+    progress = []
+    with mock.patch.object(DynamoDatastore, '_delete', side_effect=[None] * 20 + [IOError()]):
+      self.assertRaises(IOError, self.ds.rebalance, Key('/users'), 5,
+        progress=lambda state: progress.append(json.loads(json.dumps(state))))
+    assert self.ds._migrating == {'users': 4}
+    reported = progress[-1]['moved']
+    assert 0 < reported <= 20
+
+    with mock.patch.object(DynamoDatastore, '_delete') as delete:
+      state = self.ds.rebalance(Key('/users'), resume=progress[-1])
+    # only the items after the last reported one are moved again
+    assert state['moved'] == expected
+    assert expected - reported <= delete.call_count < expected - reported + 25
+    assert all(shard['done'] for shard in state['shards'].values())
+    assert not self.ds._migrating
+
+  def test_rebalance_rate(self):
+    keys = [Key('/users/%d' % i) for i in range(50)]
+    self.scan_items(keys)
+    with mock.patch.object(RateLimiter, 'acquire') as acquire:
+      with mock.patch.object(DynamoDatastore, '_delete'):
+        state = self.ds.rebalance(Key('/users'), 5, rate=100)
+    assert acquire.call_count == state['moved']
+
+  def test_configured_migration(self):
+    ds = ShardedDynamoDatastore(None, shards={'users': 5}, migrating={'users': 4}, prefix='p_')
+    ds._table_named = self.ds._table_named
+    key = next(Key('/users/%d' % i) for i in range(100)
+      if HashRing(4).shard_for('/users/%d' % i) != HashRing(5).shard_for('/users/%d' % i))
+    assert ds._previous_table(key) is self.ds._table(key)
+    assert len(ds._query_tables(Query(Key('/users')))) == 5
+
+    for table in set(self.tables.values()):
+      table.scan.return_value = []
+    assert ds.rebalance(Key('/users'))['moved'] == 0
+    assert not ds._migrating
+    assert ds.shard_count('users') == 5
+
+  def test_query_fans_out(self):
+    def translate(table, query, consistent=False):
+      values = {'p_users': [1, 2], 'p_users-shard2': [3]}.get(table.table_name, [])
+      return mock.MagicMock(__iter__=lambda self: iter(values))
+
+    with mock.patch.object(DynamoQuery, 'translate', side_effect=translate) as translated:
+      res = list(self.ds.query(Query(Key('/users'))))
+      assert sorted(res) == [1, 2, 3], res
+      assert translated.call_count == 4
+
+      res = list(self.ds.query(Query(Key('/users'), limit=2)))
+      assert len(res) == 2, res
+
+    assert self.ds.shard_stats()['p_users']['queried'] >= 1
+
+  def test_query_stops_shards(self):
+    read = Counter()
+    def translate(table, query, consistent=False):
+      def values():
+        while True:
+          read[table.table_name] += 1
+          yield table.table_name
+      return mock.MagicMock(__iter__=lambda self: values(), resume_key=None)
+
+    with mock.patch.object(DynamoQuery, 'translate', side_effect=translate):
+      assert len(list(self.ds.query(Query(Key('/users'), limit=5)))) == 5
+      cursor = iter(self.ds.query(Query(Key('/users'))))
+      next(cursor)
+      del cursor
+
+      time.sleep(0.3)
+      total = sum(read.values())
+      time.sleep(0.3)
+    assert sum(read.values()) == total
+    assert total < 4 * (ShardedDynamoDatastore.MERGE_BUFFER + 2), total
+
+  def test_query_rejects_offsets(self):
+    query = Query(Key('/users'))
+    self.assertRaises(ValueError, self.ds.query, query, token='token')
+    query.offset_key = Key('/users/1')
+    self.assertRaises(ValueError, self.ds.query, query)
+
+
+class TestNativeEncoding(unittest.TestCase):
+
+  def setUp(self):
+    self.conn = mock.Mock()
+    self.conn.scan.return_value = {'Items': []}
+    self.table = fake_table(connection=self.conn, encoding=Encoding.native)
+
+  def round_trip(self, key, value):
+    wrapped = DynamoDatastore._wrap(self.table, key, value)
+    raw = Item(self.table, data=wrapped).prepare_full()
+    stored = dict((k, self.table._dynamizer.decode(v)) for (k, v) in raw.items())
+    return raw, DynamoDatastore._unwrap(stored)
+
+  def test_round_trip(self):
+    key = Key('/test/abc')
+    value = {
+      'key': str(key), 'a': 3, 'b': {'1': 2, '2': [3, 'x', None, 1.5]}, 'c': True, 'd': False,
+      'e': '1.0', 'f': None, 'g': [], 'h': set(['x', 'y']), 'i': set([1, 2]),
+      'j': ObjectId('52a0f4d4c7f8ac0b3d5a1f00'),
+    }
+    raw, res = self.round_trip(key, value)
+    assert res == value, res
+    assert raw['b'] == {'M': {'1': {'N': '2'}, '2': {'L': [{'N': '3'}, {'S': 'x'}, {'NULL': True}, {'N': '1.5'}]}}}
+    assert raw['c'] == {'BOOL': True}
+    assert raw['h'] == {'SS': ['x', 'y']} or raw['h'] == {'SS': ['y', 'x']}
+    assert raw['j']['S'].startswith('__json__=')
+
+    for value in [True, [1, {'a': False}], None, set([1.5])]:
+      assert self.round_trip(key, value)[1] == value
+
+  def test_floats(self):
+    key = Key('/test/abc')
+    value = {'key': str(key), 'a': [0.1], 'b': {'x': 1.0}, 'c': [1.5], 'd': 19.99, 'e': set([3.14]),
+      'address': {'city': 'A', 'lat': 52.37}}
+    raw, res = self.round_trip(key, value)
+    assert res == value, res
+    assert type(res['a'][0]) is float and type(res['b']['x']) is float
+    assert raw['a'] == {'L': [{'N': '0.1'}]}
+    assert raw['address'] == {'M': {'city': {'S': 'A'}, 'lat': {'N': '52.37'}}}
+    assert raw['d'] == {'N': '19.99'}
+    assert raw['e'] == {'NS': ['3.14']}
+    # integral floats would read back as ints
+    assert raw['b']['S'].startswith('__json__=')
+
+    # the nested map stays filterable server-side, and by the client filter
+    self.conn.scan.return_value = {'Items': [raw]}
+    q = Query(Key('/test')).filter('address.city', '=', 'A').filter('address.lat', '>', 52.3)
+    assert list(DynamoQuery.translate(self.table, q)) == [value]
+    kwargs = self.conn.scan.call_args[1]
+    assert kwargs['expression_attribute_values'] == {':v0': {'S': 'A'}, ':v1': {'N': '52.3'}}, kwargs
+
+  def test_scan_filter_expression(self):
+    q = Query(Key('/test')).filter('c', '=', True).filter('b.1', '>', 1)
+    list(DynamoQuery.translate(self.table, q))
+
+    kwargs = self.conn.scan.call_args[1]
+    assert 'scan_filter' not in kwargs
+    assert kwargs['filter_expression'] == '#n0 = :v0 AND #n1.#n2 > :v1', kwargs['filter_expression']
+    assert kwargs['expression_attribute_names'] == {'#n0': 'c', '#n1': 'b', '#n2': '1'}
+    assert kwargs['expression_attribute_values'] == {':v0': {'BOOL': True}, ':v1': {'N': '1'}}
+
+  def test_nested_client_filter(self):
+    f = DynamoQuery.path_filter(Filter('b.1', '=', 2))
+    assert f({'b': {'1': 2}})
+    assert not f({'b': {'1': 3}})
+
+
+class TestSharedItemCache(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, 'cache.db')
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_get_put_delete(self):
+    cache = SharedItemCache(self.path)
+    assert cache.get('a') is None
+    cache.put('a', 'bytes')
+    assert cache.get('a') == 'bytes'
+    cache.put('a', 'more bytes')
+    assert cache.get('a') == 'more bytes'
+    assert cache.size == len('more bytes')
+    cache.delete('a')
+    assert cache.get('a') is None
+    assert cache.size == 0
+    assert cache.stats == {'hits': 2, 'misses': 2, 'hit_rate': 0.5}
+
+  def test_ttl(self):
+    cache = SharedItemCache(self.path, ttl=60)
+    cache.put('a', 'bytes')
+    cache.put('b', 'bytes', ttl=-1)
+    assert cache.get('a') == 'bytes'
+    assert cache.get('b') is None
+
+  def test_eviction(self):
+    cache = SharedItemCache(self.path, max_bytes=30)
+    for name in 'abcd':
+      cache.put(name, 'x' * 10)
+    assert cache.size <= 30
+    assert cache.get('a') is None
+    assert cache.get('d') == 'x' * 10
+
+  def test_shared_between_processes(self):
+    cache = SharedItemCache(self.path)
+    def child():
+      SharedItemCache(self.path).put('a', 'from child')
+    process = multiprocessing.Process(target=child)
+    process.start()
+    process.join()
+    assert cache.get('a') == 'from child'
+
+  def test_invalidate(self):
+    cache = SharedItemCache(self.path, tombstone=60)
+    generation = cache.generation('a')
+    cache.invalidate('a')
+    assert cache.generation('a') == generation + 1
+    assert not cache.put('a', 'stale', generation=generation)
+    assert not cache.put('a', 'too soon', generation=cache.generation('a'))
+    assert cache.get('a') is None
+    assert cache.put('a', 'written')
+
+    cache.tombstone = 0
+    assert cache.put('a', 'later', generation=cache.generation('a'))
+    assert cache.get('a') == 'later'
+
+  def test_write_during_read_across_processes(self):
+    key = Key('/test/a')
+    reading, written = multiprocessing.Event(), multiprocessing.Event()
+
+    def datastore():
+      ds = DynamoDatastore(None, cache=SharedItemCache(self.path, tombstone=0))
+      table = fake_table()
+      ds._table = lambda key: table
+      return ds, table
+
+    def reader():
+      ds, table = datastore()
+      stale = mock.Mock(_data=DynamoDatastore._wrap(table, key, {'key': str(key), 'n': 1}))
+      def get_item(**kwargs):
+        reading.set()
+        written.wait(10)
+        return stale
+      with mock.patch.object(DynamoTable, 'get_item', side_effect=get_item):
+        ds.get(key)
+
+    process = multiprocessing.Process(target=reader)
+    process.start()
+    assert reading.wait(10)
+
+    # another process writes (and invalidates) while the read is in flight
+    ds, table = datastore()
+    with mock.patch.object(Item, 'save'):
+      ds.put(key, {'key': str(key), 'n': 2})
+    written.set()
+    process.join()
+
+    assert ds.cache.get(ds._cache_key(table, key)) is None
+
+  def test_datastore_tiers(self):
+    ds = DynamoDatastore(None, cache=SharedItemCache(self.path))
+    table = fake_table()
+    ds._table = lambda key: table
+
+    key = Key('/test/a')
+    item = mock.Mock(_data=DynamoDatastore._wrap(table, key, {'key': str(key), 'n': 5}))
+    with mock.patch.object(DynamoTable, 'get_item', return_value=item) as get_item:
+      assert ds.get(key) == {'key': str(key), 'n': 5}
+      assert ds.get(key) == {'key': str(key), 'n': 5}
+      assert get_item.call_count == 1
+
+      # strong reads bypass the cache
+      ds.get(key, consistent=True)
+      assert get_item.call_count == 2
+
+      with mock.patch.object(DynamoTable, 'delete_item'):
+        ds.delete(key)
+      item._data = DynamoDatastore._wrap(table, key, {'key': str(key), 'n': 5})
+      ds.get(key)
+      assert get_item.call_count == 3
+
+    stats = ds.cache_stats()
+    assert stats['shared']['hits'] == 1, stats
+    assert stats['shared']['misses'] == 2, stats
+    assert stats['dynamo']['hits'] == 3, stats
+
+
+class FakeScanConnection(object):
+  '''Fake connection serving (parallel) scans and batch writes from memory.'''
+
+  def __init__(self, items, page_size=7):
+    self.items = dict((item['key']['S'], item) for item in items)
+    self.page_size = page_size
+    self.batches = []
+    self.fail_after = None
+    self.lock = threading.Lock()
+
+  def scan(self, table_name, segment=None, total_segments=None, exclusive_start_key=None,
+           attributes_to_get=None, limit=None, **kwargs):
+    with self.lock:
+      keys = sorted(k for k in self.items if total_segments is None or
+        HashRing._hash(k) % total_segments == segment)
+    if exclusive_start_key:
+      keys = [k for k in keys if k > exclusive_start_key['key']['S']]
+
+    page = keys[:self.page_size]
+    with self.lock:
+      items = [dict((a, v) for (a, v) in self.items[k].items() if a in attributes_to_get) for k in page]
+    result = {'Items': items}
+    if len(keys) > len(page):
+      result['LastEvaluatedKey'] = {'key': {'S': page[-1]}}
+    return result
+
+  def batch_write_item(self, request_items):
+    if self.fail_after is not None and len(self.batches) >= self.fail_after:
+      raise IOError('connection lost')
+    for requests in request_items.values():
+      assert len(requests) <= 25
+      self.batches.append(len(requests))
+      for request in requests:
+        with self.lock:
+          del self.items[request['DeleteRequest']['Key']['key']['S']]
+    return {}
+
+
+class TestDeleteQuery(unittest.TestCase):
+
+  def setUp(self):
+    items = [{'key': {'S': '/test/%03d' % i}, 'n': {'N': str(i)}, 'other': {'S': 'x'}} for i in range(100)]
+    self.conn = FakeScanConnection(items)
+    self.ds = DynamoDatastore(self.conn)
+    table = fake_table(connection=self.conn)
+    self.ds._table = lambda key, create=True: table
+
+  def test_delete_query(self):
+    calls = []
+    state = self.ds.delete_query(Query(Key('/test')).filter('n', '>=', 40), workers=3, progress=calls.append)
+    assert state['deleted'] == 60, state
+    assert sorted(self.conn.items) == ['/test/%03d' % i for i in range(40)]
+    assert len(state['segments']) == 3
+    assert all(s['done'] for s in state['segments'].values())
+    assert calls
+
+    state = self.ds.truncate(Key('/test'), rate=10000)
+    assert state['deleted'] == 40
+    assert self.conn.items == {}
+
+  def test_missing_table(self):
+    ds = DynamoDatastore(mock.Mock())
+    with mock.patch.object(DynamoTable, 'exists', return_value=False):
+      with mock.patch.object(DynamoDatastore, '_create_table') as create:
+        assert ds.truncate(Key('/missing'))['deleted'] == 0
+    assert not create.called
+
+  def test_resume(self):
+    self.conn.fail_after = 2
+    progress = []
+    self.assertRaises(IOError, self.ds.delete_query, Query(Key('/test')), workers=1,
+      progress=lambda state: progress.append(json.loads(json.dumps(state))))
+    assert len(self.conn.items) == 50, len(self.conn.items)
+
+    self.conn.fail_after = None
+    state = self.ds.delete_query(Query(Key('/test')), resume=progress[-1])
+    assert state['deleted'] == 100
+    assert self.conn.items == {}
+    assert self.conn.batches == [25, 25, 25, 25]
+
+
+class TestItemSize(unittest.TestCase):
+
+  def setUp(self):
+    self.ds = DynamoDatastore(mock.Mock(), size_sampling=1)
+    self.table = fake_table()
+    self.table._item_count = 1000
+    self.table._size_bytes = 2000 * 1024
+    self.ds._table = lambda key, create=True: self.table
+
+  def test_item_size(self):
+    assert item_size({'name': u'caf\xe9'}) == 4 + 5
+    assert item_size({'n': 12300}) == 1 + 3
+    assert item_size({'n': Decimal('0.05')}) == 1 + 2
+    assert item_size({'b': True, 'z': None}) == 2 + 2
+    assert item_size({'l': ['ab', 1]}) == 1 + 3 + (2 + 1) + (2 + 1)
+    assert item_size({'m': {'a': 'xy'}}) == 1 + 3 + (1 + 2 + 1)
+    assert item_size({'s': set(['a', 'bc'])}) == 1 + 3
+
+  def test_put_rejects_oversized(self):
+    key = Key('/test/big')
+    with mock.patch.object(Item, 'save') as save:
+      self.assertRaises(ItemTooLarge, self.ds.put, key, 'x' * MAX_ITEM_SIZE)
+      assert not save.called
+      self.ds.put(key, 'x' * 1000)
+      assert save.called
+
+    stats = self.ds.item_sizes()['test']
+    assert stats['count'] == 1
+    assert 1000 < stats['mean'] < 1100
+    assert stats['histogram'] == {1024: 1}, stats
+
+  def test_estimate_capacity(self):
+    key = Key('/test/a')
+    assert self.ds.estimate_capacity('put', key, 'x' * 1500) == 2
+    assert self.ds.estimate_capacity('get', key, 'x' * 5000) == 1
+    assert self.ds.estimate_capacity('get', key, 'x' * 5000, consistent=True) == 2
+    assert self.ds.estimate_capacity('delete', key) == 2   # table mean of 2KB
+    self.assertRaises(ValueError, self.ds.estimate_capacity, 'put', key)
+
+    # scans read the whole table, index queries only what matches
+    assert self.ds.estimate_capacity('query', query=Query(Key('/test'))) == 250
+    assert self.ds.estimate_capacity('query', query=Query(Key('/test')).filter('key', '=', '/test/a')) == 0.5
+    self.assertRaises(ValueError, self.ds.estimate_capacity, 'scan', key)
+
+  def test_estimate_missing_table(self):
+    ds = DynamoDatastore(mock.Mock())
+    with mock.patch.object(DynamoTable, 'exists', return_value=False):
+      with mock.patch.object(DynamoDatastore, '_create_table') as create:
+        assert ds.estimate_capacity('query', query=Query(Key('/missing'))) == 0
+    assert not create.called
+
+
+class TestKeyCodec(unittest.TestCase):
+
+  def test_matches_schema_inspection(self):
+    from .bench import LegacyDatastore, LegacyTable, SCHEMAS
+    def outcome(fn, *args):
+      try:
+        return fn(*args)
+      except Exception, e:
+        return type(e)
+
+    keys = [Key('/users/bob.2'), Key('/users:x/carol.3.4'), Key('/users/dave'), Key('/users/eve.x'), Key('/users/.1')]
+    values = [{}, 'plain', {'user': 'bob', 'seq': 2}, {'user': 'b.ob', 'seq': 2}, {'user': 'bob', 'seq': 3},
+      {'user': 'dave'}, {'user': 5, 'seq': 'x'}]
+    for (name, hash_key, range_key, datatypes, key, value) in SCHEMAS:
+      old = fake_table(LegacyTable, hash_key, range_key, datatypes)
+      new = fake_table(DynamoTable, hash_key, range_key, datatypes)
+      for k in [key] + keys:
+        assert outcome(new.primary_key_from_key, k) == outcome(old.primary_key_from_key, k), (name, k)
+        for v in [value] + values:
+          assert outcome(DynamoDatastore._wrap, new, k, v) == outcome(LegacyDatastore._wrap, old, k, v), (name, k, v)
+
+      valid = [k for k in [key] + keys if isinstance(outcome(old.primary_key_from_key, k), dict)]
+      assert new.primary_keys_from_keys(valid) == [old.primary_key_from_key(k) for k in valid], name
+
+  def test_wrap_uses_table_hooks(self):
+    class StrictTable(DynamoTable):
+      def validate_key_for_value(self, key, value):
+        raise ValueError('rejected')
+    strict = fake_table(StrictTable)
+    self.assertRaises(ValueError, DynamoDatastore._wrap, strict, Key('/test/a'), {'n': 1})
+
+  def test_validation(self):
+    codec = KeyCodec('user', 'seq', {'user': str, 'seq': Decimal})
+    assert codec.encode(Key('/messages/alice.1')) == {'user': 'alice', 'seq': Decimal(1)}
+    codec.validate(Key('/messages/alice.1'), {'user': 'alice', 'seq': 1})
+    self.assertRaises(ValueError, codec.validate, Key('/messages/alice.2'), {'user': 'alice', 'seq': 1})
+    self.assertRaises(ValueError, codec.validate, Key('/messages/alice.1'), {'seq': 1})
+    self.assertRaises(Exception, codec.encode, Key('/messages/alice.x'))
+
+    codec = KeyCodec('user', None, {'user': str})
+    self.assertRaises(ValueError, codec.validate, Key('/users/alice'), {'user': 'bob'})
+    assert codec.project_many([{'user': 'alice', 'n': 1}]) == [{'user': 'alice'}]
+    assert KeyCodec('user', 'seq', {}).project({'user': 'a', 'seq': 1, 'n': 2}) == {'user': 'a', 'seq': 1}
+
+
+class TestRateLimiter(unittest.TestCase):
+
+  def test_rate(self):
+    limiter = RateLimiter(200, burst=10)
+    start = time.time()
+    for _ in range(5):
+      limiter.acquire(10)
+    assert 0.15 < time.time() - start < 1
+    RateLimiter(None).acquire(10 ** 6)
+
+
 if __name__ == '__main__':
   unittest.main()